@@ -0,0 +1,555 @@
+#! /usr/bin/env python3
+#
+# possumcmd benchmarks.
+#
+# Copyright (C) 2023 Togán Labs
+# SPDX-License-Identifier: MIT
+#
+
+# Disable a bunch of pylint checks for now
+# pylint: disable=missing-docstring,invalid-name
+
+import argparse
+import functools
+import http.server
+import importlib.util
+import importlib.machinery
+import json
+import os
+import shutil
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+VERSION_STRING = "%%VERSION_STRING%%"
+
+def find_possumcmd():
+    """
+    Return the path of possumcmd in the directory containing this script, as
+    either `possumcmd.py` in the source tree or `possumcmd` once installed.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    for fname in ("possumcmd.py", "possumcmd"):
+        path = os.path.join(here, fname)
+        if os.path.exists(path):
+            return path
+    raise Exception("Cannot find possumcmd next to %s" % __file__)
+
+def load_possumcmd():
+    loader = importlib.machinery.SourceFileLoader("possumcmd", find_possumcmd())
+    spec = importlib.util.spec_from_loader("possumcmd", loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+def make_rootfs(path, size, count):
+    """
+    Create a synthetic rootfs of roughly `size` bytes in `count` files. Half of
+    each file is random and half is repetitive so that the result compresses
+    about as well as a real rootfs.
+    """
+    file_size = max(size // count, 1)
+    for i in range(count):
+        dir_path = os.path.join(path, "usr", "lib", "d%03d" % (i % 100))
+        os.makedirs(dir_path, exist_ok=True)
+        with open(os.path.join(dir_path, "f%06d" % i), "wb") as f:
+            f.write(os.urandom(file_size // 2))
+            f.write(b"possum" * ((file_size - file_size // 2) // 6))
+
+def time_call(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.monotonic()
+        func()
+        times.append(time.monotonic() - start)
+    return {'min': min(times), 'median': statistics.median(times)}
+
+ARCHIVE_FORMATS = [
+    # (name, file suffix, compressor command lines in order of preference)
+    ("tar", ".tar", [None]),
+    ("xz", ".tar.xz", [["xz", "-T0", "--block-size=4MiB", "-c"]]),
+    ("zstd", ".tar.zst", [["pzstd", "-c"], ["zstd", "-T0", "-c"]]),
+    ("lz4", ".tar.lz4", [["lz4", "-c"]]),
+    ("gzip", ".tar.gz", [["pigz", "-c"], ["gzip", "-c"]]),
+]
+
+def make_archive(rootfs_path, archive_base, suffix, commands):
+    tar_path = archive_base + ".tar"
+    if not os.path.exists(tar_path):
+        subprocess.run(["tar", "-C", rootfs_path, "-cf", tar_path, "."],
+                       check=True)
+    for command in commands:
+        if command is None:
+            return tar_path
+        if shutil.which(command[0]):
+            archive_path = archive_base + suffix
+            with open(tar_path, "rb") as src, open(archive_path, "wb") as dst:
+                subprocess.run(command, stdin=src, stdout=dst, check=True)
+            return archive_path
+    return None
+
+# Stand-in for runc which keeps container state in $FAKE_RUNC_ROOT and runs a
+# sleep process for each started container
+FAKE_RUNC = """\
+import json, os, signal, subprocess, sys, time
+
+root = os.environ["FAKE_RUNC_ROOT"]
+args = [arg for arg in sys.argv[1:] if not arg.startswith("-")]
+command = args[0] if args else sys.argv[1]
+
+def path(name):
+    return os.path.join(root, name + ".json")
+
+def load(name):
+    try:
+        with open(path(name)) as f:
+            state = json.load(f)
+    except OSError:
+        sys.exit("container %s does not exist" % name)
+    try:
+        os.kill(state["pid"], 0)
+        with open("/proc/%d/stat" % state["pid"]) as f:
+            running = f.read().split()[2] != "Z"
+    except OSError:
+        running = False
+    state["status"] = "running" if running else "stopped"
+    return state
+
+if command == "--version":
+    print("runc version 0.0.0-fake")
+elif command == "spec":
+    spec = {
+        "ociVersion": "1.0.2",
+        "process": {"terminal": True, "args": ["sh"], "cwd": "/",
+                    "capabilities": {}},
+        "root": {"path": "rootfs", "readonly": True},
+        "hostname": "runc",
+        "mounts": [{"destination": "/proc", "type": "proc", "source": "proc"}],
+    }
+    with open("config.json", "w") as f:
+        json.dump(spec, f, indent=4)
+elif command == "run":
+    proc = subprocess.Popen(["sleep", "3600"], start_new_session=True,
+                            stdin=subprocess.DEVNULL)
+    with open(path(args[1]), "w") as f:
+        json.dump({"id": args[1], "pid": proc.pid, "bundle": os.getcwd(),
+                   "created": time.strftime("%Y-%m-%dT%H:%M:%SZ")}, f)
+elif command == "kill":
+    state = load(args[1])
+    if state["status"] != "running":
+        sys.exit("container %s is not running" % args[1])
+    os.kill(state["pid"], getattr(signal, "SIG" + (args[2:] or ["TERM"])[0]))
+elif command == "state":
+    print(json.dumps(load(args[1])))
+elif command == "list":
+    names = sorted(f[:-5] for f in os.listdir(root) if f.endswith(".json"))
+    print(json.dumps([load(name) for name in names]))
+elif command == "delete":
+    state = load(args[1])
+    if state["status"] == "running":
+        os.kill(state["pid"], signal.SIGKILL)
+    os.unlink(path(args[1]))
+else:
+    sys.exit("unsupported runc command %s" % command)
+"""
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args): # pylint: disable=arguments-differ
+        pass
+
+class HermeticEnv:
+    """
+    Scratch environment in which possumcmd runs without root, real runc or a
+    network source: state, configuration and preconfiguration live under
+    `workdir`, a stub runc is first on PATH and images are served over HTTP
+    from `workdir`/www on a local port.
+    """
+
+    def __init__(self, workdir, possumcmd_path):
+        self.workdir = workdir
+        self.possumcmd_path = possumcmd_path
+        self.state_root = os.path.join(workdir, "state")
+        self.preconfig_path = os.path.join(workdir, "preconfig.d")
+        self.www_path = os.path.join(workdir, "www")
+        self.runc_root = os.path.join(workdir, "runc")
+        bin_path = os.path.join(workdir, "bin")
+        for path in (self.preconfig_path, self.www_path, self.runc_root,
+                     bin_path):
+            os.makedirs(path)
+
+        runc_path = os.path.join(bin_path, "runc")
+        with open(runc_path, "w") as f:
+            f.write("#! %s\n" % sys.executable)
+            f.write(FAKE_RUNC)
+        os.chmod(runc_path, 0o755)
+
+        config_path = os.path.join(workdir, "possumcmd.conf")
+        with open(config_path, "w") as f:
+            # Overlay mounts need root so every guest gets a copy
+            f.write("[possumcmd]\nstorage = copy\nsocket = %s\n"
+                    % os.path.join(workdir, "possumcmd.sock"))
+
+        self.env = dict(os.environ)
+        self.env.update({
+            'PATH': bin_path + os.pathsep + os.environ.get('PATH', ''),
+            'POSSUMCMD_STATE_ROOT': self.state_root,
+            'POSSUMCMD_CONFIG': config_path,
+            'POSSUMCMD_PRECONFIG': self.preconfig_path,
+            'FAKE_RUNC_ROOT': self.runc_root,
+        })
+        self.server = None
+        self.url = None
+
+    def serve(self):
+        handler = functools.partial(QuietHandler, directory=self.www_path)
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:%d" % self.server.server_port
+
+    def add_image(self, name, rootfs_path):
+        """Publish the tree at `rootfs_path` as the guest image `name`."""
+        image_path = os.path.join(self.www_path, "guest", name)
+        os.makedirs(image_path)
+        archive_path = make_archive(rootfs_path,
+                                    os.path.join(image_path, "rootfs"),
+                                    ".tar.xz", [ARCHIVE_FORMATS[1][2][0], None])
+        with open(os.path.join(image_path, "image_guest.json"), "w") as f:
+            json.dump({
+                'SYSTEM_PROFILE_TYPE': 'guest',
+                'ROOTFS': os.path.basename(archive_path),
+                'COMMAND': '/sbin/init',
+                'CAPABILITIES': ['CAP_KILL'],
+            }, f)
+
+    def run(self, *args):
+        """Run possumcmd with `args` and return the time taken."""
+        start = time.monotonic()
+        run = subprocess.run([sys.executable, self.possumcmd_path] + list(args),
+                             env=self.env, stdout=subprocess.DEVNULL,
+                             stderr=subprocess.PIPE, universal_newlines=True)
+        elapsed = time.monotonic() - start
+        if run.returncode != 0:
+            sys.stderr.write(run.stderr)
+            run.check_returncode()
+        return elapsed
+
+    def reset(self):
+        """Stop all fake guests and remove all state."""
+        for fname in os.listdir(self.runc_root):
+            with open(os.path.join(self.runc_root, fname)) as f:
+                pid = json.load(f)['pid']
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            os.unlink(os.path.join(self.runc_root, fname))
+        shutil.rmtree(self.state_root, ignore_errors=True)
+
+    def close(self):
+        self.reset()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+def summarize(times):
+    return {'min': min(times), 'median': statistics.median(times)}
+
+def setup_images(env, workdir, args):
+    """Serve `args.images` synthetic images and return their names."""
+    env.serve()
+    names = []
+    for i in range(args.images):
+        rootfs_path = os.path.join(workdir, "rootfs-%d" % i)
+        make_rootfs(rootfs_path, args.size << 20, args.files)
+        names.append("image%d" % i)
+        env.add_image(names[-1], rootfs_path)
+    return names
+
+def write_preconfig(env, images, count, enable):
+    with open(os.path.join(env.preconfig_path, "bench.conf"), "w") as f:
+        f.write("[source:bench]\nurl = %s\n" % env.url)
+        for i in range(count):
+            f.write("\n[guest:guest%d]\nimage = bench:%s\nenable = %s\n"
+                    % (i, images[i % len(images)], "yes" if enable else "no"))
+
+def bench_add_guest(possumcmd, workdir, args):
+    """Time add_guest with an empty cache and with the image cached."""
+    env = HermeticEnv(workdir, possumcmd.__file__)
+    try:
+        images = setup_images(env, workdir, args)
+        cold = []
+        warm = []
+        for _ in range(args.repeat):
+            env.reset()
+            env.run("add_source", "bench", env.url)
+            cold.append(env.run("add_guest", "guest0", "bench:" + images[0]))
+            warm.append(env.run("add_guest", "guest1", "bench:" + images[0]))
+    finally:
+        env.close()
+
+    results = [dict(operation="cold", **summarize(cold)),
+               dict(operation="warm", **summarize(warm))]
+    for result in results:
+        print("add_guest %-6s min %7.3fs  median %7.3fs"
+              % (result['operation'], result['min'], result['median']))
+    return results
+
+def bench_preconfigure(possumcmd, workdir, args):
+    """Time preconfigure of `args.guests` guests sharing `args.images` images."""
+    env = HermeticEnv(workdir, possumcmd.__file__)
+    try:
+        images = setup_images(env, workdir, args)
+        write_preconfig(env, images, args.guests, enable=False)
+        times = []
+        for _ in range(args.repeat):
+            env.reset()
+            times.append(env.run("preconfigure"))
+    finally:
+        env.close()
+
+    result = dict(guests=args.guests, images=args.images, **summarize(times))
+    print("preconfigure %d guests  min %7.3fs  median %7.3fs"
+          % (args.guests, result['min'], result['median']))
+    return [result]
+
+def bench_autostart(possumcmd, workdir, args):
+    """Time autostart_all and autostop_all with `args.guests` guests."""
+    env = HermeticEnv(workdir, possumcmd.__file__)
+    try:
+        images = setup_images(env, workdir, args)
+        write_preconfig(env, images, args.guests, enable=True)
+        env.run("preconfigure")
+        start_times = []
+        stop_times = []
+        for _ in range(args.repeat):
+            start_times.append(env.run("autostart_all"))
+            stop_times.append(env.run("autostop_all"))
+    finally:
+        env.close()
+
+    results = [dict(operation="autostart_all", guests=args.guests,
+                    **summarize(start_times)),
+               dict(operation="autostop_all", guests=args.guests,
+                    **summarize(stop_times))]
+    for result in results:
+        print("%-13s %d guests  min %7.3fs  median %7.3fs"
+              % (result['operation'], args.guests, result['min'],
+                 result['median']))
+    return results
+
+def bench_state(possumcmd, workdir, args):
+    """Time state commands with `args.entries` guests defined."""
+    env = HermeticEnv(workdir, possumcmd.__file__)
+    try:
+        # Fill the state directly as creating real guests would take too long
+        os.makedirs(env.state_root)
+        state = possumcmd.PossumState(os.path.join(env.state_root, "state.db"))
+        guests = {}
+        for i in range(args.entries):
+            guests["guest%d" % i] = {
+                'image_name': "image0",
+                'image': {'COMMAND': '/sbin/init', 'CAPABILITIES': []},
+                'source_name': "bench",
+                'source': {'url': "http://127.0.0.1"},
+                'path': os.path.join(env.state_root, "guest%d" % i),
+                'autostart_enabled': 0,
+                'storage': "copy",
+                'created': time.time(),
+            }
+        state.import_json({'sources': {'bench': {'url': "http://127.0.0.1"}},
+                           'guests': guests})
+        state.close()
+
+        middle = "guest%d" % (args.entries // 2)
+        operations = [
+            ("list_guests", ["list_guests"]),
+            ("show_guest", ["show_guest", middle]),
+            ("enable_guest", ["enable_guest", middle]),
+            ("disable_guest", ["disable_guest", middle]),
+        ]
+        results = []
+        for (name, command) in operations:
+            times = [env.run(*command)]
+            for _ in range(args.repeat - 1):
+                if name in ("enable_guest", "disable_guest"):
+                    # Undo the change so that the command succeeds again
+                    env.run("disable_guest" if name == "enable_guest"
+                            else "enable_guest", middle)
+                times.append(env.run(*command))
+            results.append(dict(operation=name, entries=args.entries,
+                                **summarize(times)))
+            print("%-13s %d guests  min %7.3fs  median %7.3fs"
+                  % (name, args.entries, results[-1]['min'],
+                     results[-1]['median']))
+    finally:
+        env.close()
+    return results
+
+def bench_formats(possumcmd, workdir, args):
+    """Time install_rootfs for each supported archive format."""
+    rootfs_path = os.path.join(workdir, "rootfs-src")
+    make_rootfs(rootfs_path, args.size << 20, args.files)
+    cache = possumcmd.ArtifactCache(os.path.join(workdir, "cache"), 0)
+    downloader = possumcmd.Downloader(possumcmd.HttpClient())
+
+    results = []
+    for (name, suffix, commands) in ARCHIVE_FORMATS:
+        archive_path = make_archive(rootfs_path, os.path.join(workdir, "rootfs"),
+                                    suffix, commands)
+        if archive_path is None:
+            print("%-8s skipped, no compressor available" % name)
+            continue
+
+        dest_path = os.path.join(workdir, "rootfs-dest")
+        def install():
+            shutil.rmtree(dest_path, ignore_errors=True)
+            possumcmd.install_rootfs("file://" + archive_path, dest_path, cache,
+                                     downloader)
+
+        timing = time_call(install, args.repeat)
+        archive_size = os.path.getsize(archive_path)
+        print("%-8s %10d bytes  min %7.3fs  median %7.3fs"
+              % (name, archive_size, timing['min'], timing['median']))
+        results.append(dict(format=name, archive_size=archive_size, **timing))
+    return results
+
+def parse_importtime(stderr):
+    """
+    Return a dict mapping each top-level module imported in a run with
+    `python -X importtime` to its cumulative import time in microseconds.
+    """
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        name = fields[2]
+        if name.startswith(" ") and not name.startswith("  "):
+            modules[name.strip()] = int(fields[1])
+    return modules
+
+def bench_startup(possumcmd, workdir, args):
+    """
+    Time cold starts of read-only commands and check the time spent importing
+    modules beyond those loaded by the interpreter itself against a budget.
+    """
+    path = possumcmd.__file__
+    env = HermeticEnv(workdir, path)
+    baseline = subprocess.run([sys.executable, "-X", "importtime", "-c", "pass"],
+                              stderr=subprocess.PIPE, check=True,
+                              universal_newlines=True)
+    baseline_modules = set(parse_importtime(baseline.stderr))
+
+    results = []
+    for command in args.startup_commands.split(","):
+        wall_times = []
+        import_times = []
+        for _ in range(args.repeat):
+            start = time.monotonic()
+            run = subprocess.run([sys.executable, "-X", "importtime", path,
+                                  command], env=env.env,
+                                 stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.PIPE, check=True,
+                                 universal_newlines=True)
+            wall_times.append(time.monotonic() - start)
+            modules = parse_importtime(run.stderr)
+            imported = {name: usec for (name, usec) in modules.items()
+                        if name not in baseline_modules}
+            import_times.append(sum(imported.values()) / 1e6)
+
+        slowest = sorted(imported, key=imported.get, reverse=True)[:5]
+        over_budget = min(import_times) * 1000 > args.startup_budget
+        print("%-12s wall min %7.3fs  imports min %7.3fs%s  (slowest: %s)"
+              % (command, min(wall_times), min(import_times),
+                 "  OVER BUDGET" if over_budget else "", ", ".join(slowest)))
+        results.append({
+            'command': command,
+            'min': min(wall_times),
+            'median': statistics.median(wall_times),
+            'imports_min': min(import_times),
+            'slowest_imports': slowest,
+            'budget': args.startup_budget / 1000,
+            'over_budget': over_budget,
+        })
+    return results
+
+BENCHMARKS = {
+    'formats': bench_formats,
+    'startup': bench_startup,
+    'add_guest': bench_add_guest,
+    'preconfigure': bench_preconfigure,
+    'autostart': bench_autostart,
+    'state': bench_state,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark possumcmd")
+    parser.add_argument("benchmarks", metavar="BENCHMARK", nargs="*",
+                        help="benchmarks to run (default: all of %s)"
+                        % ", ".join(BENCHMARKS))
+    parser.add_argument("--json", metavar="FILE",
+                        help="write results to FILE in JSON format")
+    parser.add_argument("--size", type=int, default=64,
+                        help="size in MiB of synthetic rootfs images")
+    parser.add_argument("--files", type=int, default=2000,
+                        help="number of files in synthetic rootfs images")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="number of times to repeat each measurement")
+    parser.add_argument("--guests", type=int, default=10,
+                        help="number of guests created by the preconfigure "
+                        "and autostart benchmarks")
+    parser.add_argument("--images", type=int, default=2,
+                        help="number of distinct images served to guests")
+    parser.add_argument("--entries", type=int, default=2000,
+                        help="number of guests defined for the state benchmark")
+    parser.add_argument("--startup-commands",
+                        default="version,help,list_sources,list_guests",
+                        help="comma-separated commands timed by the startup "
+                        "benchmark")
+    parser.add_argument("--startup-budget", type=float, default=50,
+                        help="maximum time in ms which the startup benchmark "
+                        "allows each command to spend importing modules")
+    args = parser.parse_args()
+
+    names = args.benchmarks or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error("Unknown benchmark \"%s\"" % name)
+
+    possumcmd = load_possumcmd()
+    report = {
+        'version': VERSION_STRING,
+        'time': time.time(),
+        'cpus': os.cpu_count(),
+        'parameters': {'size': args.size, 'files': args.files,
+                       'repeat': args.repeat, 'guests': args.guests,
+                       'images': args.images, 'entries': args.entries},
+        'results': {},
+    }
+    for name in names:
+        print("Running benchmark \"%s\"..." % name)
+        with tempfile.TemporaryDirectory(prefix="possumcmd-bench-") as workdir:
+            report['results'][name] = BENCHMARKS[name](possumcmd, workdir, args)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=4)
+            f.write("\n")
+
+    over_budget = [result for results in report['results'].values()
+                   for result in results if result.get('over_budget')]
+    if over_budget:
+        print("%d measurements over budget" % len(over_budget))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
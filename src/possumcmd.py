@@ -8,49 +8,1698 @@
 
 # Disable a bunch of pylint checks for now
 # pylint: disable=missing-docstring,no-self-use,fixme,too-many-public-methods
+# pylint: disable=import-outside-toplevel
 
+# Modules which are slow to import are imported by the functions which use
+# them so that simple commands start quickly
 import cmd
-import configparser
+import collections
+import collections.abc
+import errno
 import fcntl
+import functools
+import io
 import json
 import logging
 import os
-import shlex
-import shutil
-import subprocess
+import stat
 import sys
-import tarfile
+import threading
 import time
-import urllib.request
-
-from datetime import datetime
 
 APP_NAME = "possumcmd"
 VERSION_STRING = "%%VERSION_STRING%%"
 
-def get_image_config(image_root):
+# Locations of possumcmd's files, which may be overridden in the environment
+# so that possumcmd can run against a scratch directory as in possumcmd-bench
+CONFIG_PATH = os.environ.get("POSSUMCMD_CONFIG", "/etc/possumcmd.conf")
+STATE_ROOT = os.environ.get("POSSUMCMD_STATE_ROOT", "/var/lib/possum-guests")
+PRECONFIG_PATH = os.environ.get("POSSUMCMD_PRECONFIG",
+                                "/usr/share/possum/preconfig.d")
+
+# Files and directories in STATE_ROOT which must not be used as guest names
+RESERVED_NAMES = ('cache', 'layers', 'preconfigure-done', 'state',
+                  'state.migrated', 'state.db', 'state.db-journal', 'state.lock')
+
+CONFIG_DEFAULTS = {
+    # Maximum number of guests started concurrently by autostart_all
+    'start_jobs': '4',
+    # Maximum number of images fetched concurrently by preconfigure
+    'fetch_jobs': '4',
+    # Seconds to wait after SIGTERM before guests are forcibly deleted
+    'stop_timeout': '10',
+    # Maximum size in MiB of downloaded rootfs archives kept in the cache, or 0
+    # to disable the cache
+    'cache_size': '1024',
+    # Seconds for which fetched image metadata is used without checking the
+    # source for changes
+    'metadata_ttl': '300',
+    # Seconds for which fetched source catalogs, used to find unqualified image
+    # names and by list_images and search_images, are used without checking
+    # the source for changes
+    'catalog_ttl': '3600',
+    # Never contact sources for image metadata, using only cached copies
+    'offline': 'no',
+    # Seconds to wait for a response from a source before giving up
+    'http_timeout': '60',
+    # Number of times an interrupted download is resumed before giving up
+    'download_retries': '5',
+    # Number of parallel ranged requests used to download each rootfs archive.
+    # Archives downloaded in several segments cannot be streamed straight into
+    # the extractor
+    'download_segments': '1',
+    # Minimum size in MiB of each segment of a rootfs archive download
+    'segment_size': '32',
+    # How new guests store their rootfs: 'overlay' shares a read-only copy of
+    # each image between guests, 'copy' gives each guest a full private copy
+    # and 'auto' uses 'overlay' if the kernel supports it
+    'storage': 'auto',
+    # Path of the UNIX socket on which 'possumcmd daemon' serves requests
+    'socket': '/run/possumcmd.sock',
+    # Size in KiB beyond which a guest's log file is rotated by start_guest or
+    # rotate_logs
+    'log_size': '1024',
+    # Number of rotated, compressed log files kept for each guest
+    'log_count': '4',
+}
+
+# Commands which are always run in the calling process rather than being
+# passed to a running daemon, as they run for a long time or interactively
+LOCAL_COMMANDS = ('daemon', 'events', 'logs', 'make_manifest', 'pull', 'runc',
+                  'verify', 'help', 'version', 'exit')
+
+# Commands which only read the state, which a daemon runs alongside each other
+# and alongside any command which changes the state
+READ_ONLY_COMMANDS = ('cache_list', 'list_guests', 'list_sources', 'metrics',
+                      'ps', 'show_guest', 'show_source')
+
+def load_config(config_path=None):
+    import configparser
+    config = configparser.ConfigParser()
+    config.read_dict({APP_NAME: CONFIG_DEFAULTS})
+    config.read(config_path or CONFIG_PATH)
+    return config[APP_NAME]
+
+class Span:
+    """A timed phase of a command, recorded by Tracer when it ends."""
+
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start = None
+        self.end = None
+        self.thread = None
+
+    def set(self, **args):
+        """Add details such as byte or file counts to the span."""
+        self.args.update(args)
+
+    def __enter__(self):
+        self.thread = threading.get_native_id()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.end = time.perf_counter()
+        self.tracer.record(self)
+
+class NullSpan:
+    """Stands in for Span when tracing is disabled."""
+
+    def set(self, **args):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+NULL_SPAN = NullSpan()
+
+class Tracer:
+    """
+    Collects timed spans around the phases of each command, from any thread,
+    to be summarized by --profile or written as a Chrome trace by --trace. No
+    spans are recorded unless the tracer is enabled.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.spans = []
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+
+    def span(self, name, category="phase", **args):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, category, args)
+
+    def record(self, span):
+        with self.lock:
+            self.spans.append(span)
+
+    def print_profile(self):
+        """Log the number of calls and time taken by each kind of span."""
+        totals = {}
+        for span in self.spans:
+            total = totals.setdefault(span.name, {'calls': 0, 'total': 0.0,
+                                                  'max': 0.0, 'bytes': 0,
+                                                  'files': 0})
+            duration = span.end - span.start
+            total['calls'] += 1
+            total['total'] += duration
+            total['max'] = max(total['max'], duration)
+            total['bytes'] += span.args.get('bytes', 0)
+            total['files'] += span.args.get('files', 0)
+
+        width = max([len(name) for name in totals] + [len("PHASE")])
+        logging.info("%-*s  %5s  %9s  %9s  %10s  %7s", width, "PHASE", "CALLS",
+                     "TOTAL", "MAX", "BYTES", "FILES")
+        for name in sorted(totals, key=lambda name: -totals[name]['total']):
+            total = totals[name]
+            logging.info("%-*s  %5d  %8.3fs  %8.3fs  %10s  %7s", width, name,
+                         total['calls'], total['total'], total['max'],
+                         format_size(total['bytes']) if total['bytes'] else "-",
+                         total['files'] or "-")
+
+    def write_trace(self, path):
+        """Write the spans to `path` in Chrome trace event format."""
+        pid = os.getpid()
+        events = []
+        for span in self.spans:
+            events.append({
+                'name': span.name,
+                'cat': span.category,
+                'ph': 'X',
+                'ts': (span.start - self.origin) * 1e6,
+                'dur': (span.end - span.start) * 1e6,
+                'pid': pid,
+                'tid': span.thread,
+                'args': span.args,
+            })
+        with open(path, "w") as trace_file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'},
+                      trace_file)
+            trace_file.write("\n")
+
+TRACER = Tracer()
+
+def traced(name):
+    """Decorator which records each call of a function as a span."""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with TRACER.span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def releases_state_on_error(method):
+    """
+    Decorator for PossumSysmgr methods which lock the state, so that an
+    exception never leaves the lock held or a half-changed state snapshot
+    behind for the next command.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        except BaseException:
+            self.abort()
+            raise
+    return wrapper
+
+def parse_guest_list(value):
+    return value.replace(',', ' ').split()
+
+def run_scheduled(names, guests, action, jobs):
+    """
+    Run `action(name)` for each guest in `names` using up to `jobs` worker
+    threads. A guest is only started once every guest listed in its `after` or
+    `requires` entries which is also in `names` has finished. A guest whose
+    `requires` entries have not all succeeded is not started at all. Returns a
+    dict mapping each name to True on success or False on failure.
+    """
+    import concurrent.futures
+    waits = {}
+    for name in names:
+        guest = guests[name]
+        after = set(guest.get('after', [])) | set(guest.get('requires', []))
+        waits[name] = after & set(names)
+
+    pending = list(names)
+    results = {}
+    running = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        while pending or running:
+            for name in list(pending):
+                if not waits[name] <= results.keys():
+                    continue
+                pending.remove(name)
+                failed = [r for r in guests[name].get('requires', [])
+                          if not results.get(r, False)]
+                if failed:
+                    logging.error("Not starting guest \"%s\": required guests "
+                                  "not started: %s", name, ", ".join(failed))
+                    results[name] = False
+                else:
+                    running[executor.submit(action, name)] = name
+
+            if not running:
+                if pending:
+                    logging.error("Dependency cycle between guests: %s",
+                                  ", ".join(pending))
+                    for name in pending:
+                        results[name] = False
+                    pending = []
+                continue
+
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+
+    return results
+
+class HttpResponse:
+    """
+    Response from HttpClient. The underlying connection is returned to the
+    client for reuse when the response is closed after being read completely.
+    """
+
+    def __init__(self, client, key, conn, response, url):
+        self.client = client
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.url = url
+        self.status = response.status
+        self.headers = response.headers
+
+    def read(self, size=-1):
+        return self.response.read(None if size < 0 else size)
+
+    def close(self):
+        if self.conn is None:
+            return
+        if self.response.isclosed() and not self.response.will_close:
+            self.client.release(self.key, self.conn)
+        else:
+            self.conn.close()
+        self.conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def proxy_auth_headers(proxy):
+    """Return the headers authenticating with the proxy at URL `proxy`."""
+    import base64
+    import urllib.parse
+    parts = urllib.parse.urlsplit(proxy)
+    if not parts.username:
+        return {}
+    credentials = "%s:%s" % (urllib.parse.unquote(parts.username),
+                             urllib.parse.unquote(parts.password or ""))
+    token = base64.b64encode(credentials.encode('utf-8')).decode('ascii')
+    return {'Proxy-Authorization': "Basic " + token}
+
+class HttpClient:
+    """
+    HTTP/1.1 client which keeps connections to each host open so that they can
+    be reused by later requests, avoiding a new TCP and TLS handshake each time.
+    It may be shared between threads. Redirects are followed and error statuses
+    raise urllib.error.HTTPError, as for urllib.request.urlopen(), which is
+    used for URL schemes other than http and https. Proxies are configured
+    from the http_proxy, https_proxy and no_proxy environment variables as for
+    urlopen(), with https requests tunnelled through the proxy.
+    """
+
+    def __init__(self, timeout=60, retries=5):
+        self.timeout = timeout
+        self.retries = retries
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.proxies = None
+
+    def _proxy(self, parts):
+        """Return the URL of the proxy to use for the split URL `parts`."""
+        import urllib.request
+        if self.proxies is None:
+            self.proxies = urllib.request.getproxies()
+        proxy = self.proxies.get(parts.scheme)
+        if not proxy or urllib.request.proxy_bypass(parts.netloc):
+            return None
+        if "://" not in proxy:
+            proxy = "http://" + proxy
+        return proxy
+
+    def release(self, key, conn):
+        with self.lock:
+            self.idle.setdefault(key, []).append(conn)
+
+    def request(self, method, url, headers=None):
+        import urllib.error
+        import urllib.parse
+        import urllib.request
+        headers = headers or {}
+        for _ in range(10):
+            parts = urllib.parse.urlsplit(url)
+            if parts.scheme not in ("http", "https"):
+                request = urllib.request.Request(url, headers=headers,
+                                                 method=method)
+                return urllib.request.urlopen(request, timeout=self.timeout)
+
+            proxy = self._proxy(parts)
+            key = (parts.scheme, parts.netloc, proxy)
+            # Proxy credentials must not follow a redirect to another host
+            hop_headers = headers
+            if proxy and parts.scheme == "http":
+                # Plain http requests are sent to the proxy with the full URL
+                path = urllib.parse.urlunsplit(parts._replace(fragment=""))
+                hop_headers = dict(headers, **proxy_auth_headers(proxy))
+            else:
+                path = urllib.parse.urlunsplit(("", "", parts.path or "/",
+                                                parts.query, ""))
+            (conn, response) = self._send(key, method, path, hop_headers)
+            if response.status in (301, 302, 303, 307, 308):
+                response.read()
+                HttpResponse(self, key, conn, response, url).close()
+                url = urllib.parse.urljoin(url, response.headers['Location'])
+                continue
+            if response.status >= 300:
+                body = response.read()
+                HttpResponse(self, key, conn, response, url).close()
+                raise urllib.error.HTTPError(url, response.status,
+                                             response.reason, response.headers,
+                                             io.BytesIO(body))
+            return HttpResponse(self, key, conn, response, url)
+        raise urllib.error.URLError("too many redirects for %s" % url)
+
+    def _send(self, key, method, path, headers):
+        import http.client
+        with self.lock:
+            idle = self.idle.get(key)
+            conn = idle.pop() if idle else None
+        if conn:
+            try:
+                conn.request(method, path, headers=headers)
+                return (conn, conn.getresponse())
+            except (OSError, http.client.HTTPException):
+                # The server closed the idle connection, try a fresh one
+                conn.close()
+
+        (scheme, netloc, proxy) = key
+        if proxy:
+            proxy_netloc = proxy.split("://", 1)[1].rpartition("@")[2]
+            if scheme == "https":
+                conn = http.client.HTTPSConnection(proxy_netloc,
+                                                   timeout=self.timeout)
+                conn.set_tunnel(netloc, headers=proxy_auth_headers(proxy))
+            else:
+                conn = http.client.HTTPConnection(proxy_netloc,
+                                                  timeout=self.timeout)
+        elif scheme == "https":
+            conn = http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        else:
+            conn = http.client.HTTPConnection(netloc, timeout=self.timeout)
+        try:
+            conn.request(method, path, headers=headers)
+            return (conn, conn.getresponse())
+        except BaseException:
+            conn.close()
+            raise
+
+class ResumableReader:
+    """
+    File-like reader for the bytes `start` to `end` (inclusive, or to the end
+    of the file if None) of `url`. If the transfer fails part way through, it
+    is resumed with a Range request for the remaining data, up to the client's
+    retry limit. `validator` may give the ETag or Last-Modified value which the
+    file must still match when resuming.
+    """
+
+    def __init__(self, client, url, start=0, end=None, validator=None):
+        self.client = client
+        self.url = url
+        self.offset = start
+        self.end = end
+        self.validator = validator
+        self.response = None
+
+    def _open(self):
+        import urllib.error
+        headers = {}
+        ranged = self.offset > 0 or self.end is not None
+        if ranged:
+            headers['Range'] = "bytes=%d-%s" % (
+                self.offset, "" if self.end is None else self.end)
+            if self.validator:
+                headers['If-Range'] = self.validator
+        self.response = self.client.request("GET", self.url, headers)
+        if ranged and self.response.status != 206:
+            self.close()
+            raise urllib.error.URLError("%s cannot be resumed from byte %d"
+                                        % (self.url, self.offset))
+
+        if self.validator is None:
+            self.validator = (self.response.headers.get("ETag") or
+                              self.response.headers.get("Last-Modified"))
+        if self.end is None:
+            length = self.response.headers.get("Content-Length")
+            if length is not None:
+                self.end = self.offset + int(length) - 1
+
+    def read(self, size=-1):
+        import http.client
+        import urllib.error
+        attempt = 0
+        while True:
+            try:
+                if self.response is None:
+                    self._open()
+                data = self.response.read(size)
+                if data or size == 0 or self.end is None or \
+                        self.offset > self.end:
+                    self.offset += len(data)
+                    return data
+                err = "connection closed early"
+            except urllib.error.URLError:
+                # Errors reported by the server are not worth retrying
+                raise
+            except (OSError, http.client.HTTPException) as read_err:
+                err = read_err
+
+            attempt += 1
+            if attempt > self.client.retries:
+                raise urllib.error.URLError("%s: %s" % (self.url, err))
+            delay = min(2 ** attempt, 30)
+            logging.warning("Download of \"%s\" interrupted at byte %d (%s), "
+                            "resuming in %ds", self.url, self.offset, err, delay)
+            self.close()
+            time.sleep(delay)
+
+    def close(self):
+        if self.response is not None:
+            self.response.close()
+            self.response = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def download_segmented(client, url, fileobj, segments, min_segment_size):
+    """
+    Download `url` into `fileobj` using up to `segments` ranged requests in
+    parallel, each of at least `min_segment_size` bytes. Returns False without
+    downloading anything if the file is too small to split or the server does
+    not support ranged requests.
+    """
+    import concurrent.futures
+    import urllib.error
+    with client.request("HEAD", url) as response:
+        response.read()
+        length = int(response.headers.get("Content-Length") or 0)
+        ranges = response.headers.get("Accept-Ranges") == "bytes"
+        validator = (response.headers.get("ETag") or
+                     response.headers.get("Last-Modified"))
+    segments = min(segments, length // max(min_segment_size, 1))
+    if not ranges or segments < 2:
+        return False
+
+    logging.debug("Retrieving \"%s\" in %d segments...", url, segments)
+    fileobj.truncate(length)
+    fd = fileobj.fileno()
+
+    def fetch(index):
+        start = index * length // segments
+        end = (index + 1) * length // segments - 1
+        with ResumableReader(client, url, start, end, validator) as reader:
+            offset = start
+            for chunk in iter(lambda: reader.read(1 << 20), b""):
+                os.pwrite(fd, chunk, offset)
+                offset += len(chunk)
+        if offset != end + 1:
+            raise urllib.error.URLError("short read of %s" % url)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=segments) as executor:
+        for _ in executor.map(fetch, range(segments)):
+            pass
+    return True
+
+class MetadataCache:
+    """
+    Local cache of small metadata files fetched from sources, such as
+    `image_guest.json`. Each entry holds the body along with the ETag and
+    Last-Modified validators returned by the server. Entries younger than `ttl`
+    seconds are used as-is; older entries are revalidated with a conditional
+    request. In `offline` mode, or if the source cannot be reached, cached
+    entries are used regardless of age.
+    """
+
+    def __init__(self, cache_path, ttl, http, offline=False):
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.http = http
+        self.offline = offline
+
+    def entry_path(self, url):
+        import hashlib
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_path, key)
+
+    def fetch(self, url):
+        """Return the body of `url` as a string."""
+        import urllib.error
+        entry = self._read(url)
+        if entry and (self.offline or time.time() - entry['fetched'] < self.ttl):
+            logging.debug("Using cached \"%s\"", url)
+            return entry['body']
+        if self.offline:
+            raise urllib.error.URLError("not cached and offline mode is enabled")
+
+        headers = {}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+        logging.debug("Retrieving \"%s\"...", url)
+        try:
+            with self.http.request("GET", url, headers) as response:
+                body = response.read().decode('utf-8')
+                headers = response.headers
+        except urllib.error.HTTPError as err:
+            if err.code != 304 or not entry:
+                raise
+            logging.debug("Cached \"%s\" is still valid", url)
+            entry['fetched'] = time.time()
+            self._write(url, entry)
+            return entry['body']
+        except OSError as err:
+            if not entry:
+                raise
+            logging.warning("Cannot reach \"%s\", using cached copy: %s", url,
+                            err)
+            return entry['body']
+
+        self._write(url, {
+            'url': url,
+            'etag': headers.get("ETag"),
+            'last_modified': headers.get("Last-Modified"),
+            'fetched': time.time(),
+            'body': body,
+        })
+        return body
+
+    def _read(self, url):
+        try:
+            with open(self.entry_path(url)) as entry_file:
+                entry = json.load(entry_file)
+        except (OSError, ValueError):
+            return None
+        return entry if entry.get('url') == url else None
+
+    def _write(self, url, entry):
+        import tempfile
+        os.makedirs(self.cache_path, exist_ok=True)
+        path = self.entry_path(url)
+        with tempfile.NamedTemporaryFile('w', dir=self.cache_path, prefix="tmp",
+                                         delete=False) as tmp:
+            json.dump(entry, tmp)
+        os.replace(tmp.name, path)
+
+@traced("fetch_metadata")
+def get_image_config(image_root, metadata_cache):
     image_url = os.path.join(image_root, "image_guest.json")
+    return json.loads(metadata_cache.fetch(image_url))
+
+class HashingReader:
+    """
+    File-like wrapper which computes the SHA-256 digest of all data read through
+    it and optionally copies that data into the file `tee`.
+    """
+
+    def __init__(self, fileobj, tee=None):
+        import hashlib
+        self.fileobj = fileobj
+        self.tee = tee
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.digest.update(data)
+        self.size += len(data)
+        if self.tee:
+            self.tee.write(data)
+        return data
+
+    def drain(self):
+        """Read and discard any data remaining in the underlying file."""
+        while self.read(1 << 20):
+            pass
+
+def remove_stale_tmp(path, max_age=24 * 60 * 60):
+    """
+    Remove temporary files and directories under `path` left behind by
+    interrupted commands. Recent entries are kept as they may still be in use.
+    """
+    import shutil
+    if not os.path.isdir(path):
+        return
+    for fname in os.listdir(path):
+        tmp_path = os.path.join(path, fname)
+        if not fname.startswith("tmp"):
+            continue
+        if time.time() - os.lstat(tmp_path).st_mtime < max_age:
+            continue
+        logging.debug("Removing stale \"%s\"", tmp_path)
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path)
+        else:
+            os.unlink(tmp_path)
+
+def prometheus_escape(value):
+    """Escape a label value for the Prometheus text format."""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_size(size):
+    for unit in ("B", "KiB", "MiB"):
+        if size < 1024:
+            return "%d %s" % (size, unit)
+        size /= 1024
+    return "%.1f GiB" % size
+
+# Locks held by threads of this process while they hold an fcntl lock on a
+# path, since fcntl locks only exclude other processes
+PATH_LOCKS = {}
+PATH_LOCKS_LOCK = threading.Lock()
+
+def path_lock(path):
+    """Return the threading lock used by this process for `path`."""
+    with PATH_LOCKS_LOCK:
+        return PATH_LOCKS.setdefault(path, threading.Lock())
+
+class LockedJsonFile:
+    """
+    JSON document stored in a file which is locked for exclusive access between
+    lock_and_read() and either unlock_and_write() or unlock_and_discard(). The
+    lock excludes both other processes and other threads of this process.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.mutex = path_lock(path)
+
+    def lock_and_read(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.mutex.acquire()
+        self.file = open(self.path, 'a+')
+        fcntl.lockf(self.file, fcntl.LOCK_EX)
+        self.file.seek(0)
+        data = self.file.read()
+        if not data:
+            return {}
+        return json.loads(data)
+
+    def unlock_and_write(self, data):
+        self.file.seek(0)
+        self.file.truncate()
+        json.dump(data, self.file, indent=4, sort_keys=True)
+        self.file.write("\n")
+        self.file.close()
+        self.mutex.release()
+
+    def unlock_and_discard(self):
+        self.file.close()
+        self.mutex.release()
+
+class Downloader:
+    """
+    Fetches rootfs archives using a shared HttpClient. Interrupted transfers
+    are resumed and, if `segments` is greater than 1, large archives are split
+    into that many segments of at least `min_segment_size` bytes which are
+    downloaded in parallel.
+    """
+
+    def __init__(self, http, segments=1, min_segment_size=0):
+        self.http = http
+        self.segments = segments
+        self.min_segment_size = min_segment_size
+
+    def open(self, url):
+        return ResumableReader(self.http, url)
+
+    def download(self, url, fileobj):
+        """
+        Download `url` into `fileobj`, which must be empty. Returns the SHA-256
+        digest of the data.
+        """
+        with TRACER.span("download", url=url) as span:
+            digest = self._download(url, fileobj)
+            span.set(bytes=fileobj.tell())
+        return digest
+
+    def _download(self, url, fileobj):
+        import hashlib
+        import urllib.parse
+        logging.debug("Retrieving \"%s\"...", url)
+        if self.segments > 1 and urllib.parse.urlsplit(url).scheme in (
+                "http", "https"):
+            if download_segmented(self.http, url, fileobj, self.segments,
+                                  self.min_segment_size):
+                # Segments arrive out of order so hash the result afterwards
+                digest = hashlib.sha256()
+                fileobj.seek(0)
+                for chunk in iter(lambda: fileobj.read(1 << 20), b""):
+                    digest.update(chunk)
+                return digest.hexdigest()
+
+        with self.open(url) as response:
+            reader = HashingReader(response, fileobj)
+            reader.drain()
+        return reader.digest.hexdigest()
+
+class ArtifactCache:
+    """
+    Local cache of downloaded rootfs archives. Archives are stored under
+    `blobs/` named by their SHA-256 digest and the index maps each source URL
+    to the digest of the archive downloaded from it. Once the total size
+    exceeds `max_size` bytes, the least recently used archives are evicted.
+    Archives of pulled images are pinned, so they are never evicted and do not
+    count towards `max_size`.
+    """
+
+    def __init__(self, cache_path, max_size):
+        self.cache_path = cache_path
+        self.blobs_path = os.path.join(cache_path, "blobs")
+        self.max_size = max_size
+        self.index = LockedJsonFile(os.path.join(cache_path, "index"))
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def blob_path(self, digest):
+        return os.path.join(self.blobs_path, digest)
+
+    def lookup(self, url, expected_digest=None, pin=False):
+        """
+        Return the path of the cached archive for `url` or None. If
+        `expected_digest` is given, an archive with another digest is ignored.
+        If `pin` is set, the archive is pinned.
+        """
+        index = self.index.lock_and_read()
+        entry = index.get(url)
+        if entry is None:
+            self.index.unlock_and_discard()
+            return None
+        if expected_digest is not None and \
+                entry['digest'] != expected_digest.lower():
+            logging.debug("Cached archive for \"%s\" is out of date", url)
+            self.index.unlock_and_discard()
+            return None
+
+        path = self.blob_path(entry['digest'])
+        if not os.path.exists(path):
+            logging.debug("Cached archive for \"%s\" has gone missing", url)
+            del index[url]
+            self.index.unlock_and_write(index)
+            return None
+
+        entry['last_used'] = time.time()
+        if pin:
+            entry['pinned'] = True
+        self.index.unlock_and_write(index)
+        return path
+
+    def fetch(self, url, downloader, expected_digest=None, pin=False):
+        """
+        Return the path of the archive for `url`, downloading it into the cache
+        first if needed. If `expected_digest` is given, a downloaded archive
+        with another digest is discarded and ValueError raised. If `pin` is
+        set, the archive is pinned.
+        """
+        path = self.lookup(url, expected_digest, pin)
+        if path:
+            logging.debug("Using cached archive \"%s\"", path)
+            return path
 
-    logging.debug("Retrieving \"%s\"...", image_url)
-    image_json = urllib.request.urlopen(image_url).read().decode('utf-8')
-    return json.loads(image_json)
+        tmp = self.begin()
+        try:
+            digest = downloader.download(url, tmp)
+            check_digest(url, digest, expected_digest)
+        except BaseException:
+            self.abort(tmp)
+            raise
+        tmp.close()
+        return self.add(url, tmp.name, digest, pin)
+
+    def begin(self):
+        """
+        Return a new temporary file in the cache directory into which an
+        archive may be downloaded before it is passed to add().
+        """
+        import tempfile
+        os.makedirs(self.blobs_path, exist_ok=True)
+        return tempfile.NamedTemporaryFile("w+b", dir=self.blobs_path,
+                                           prefix="tmp", delete=False)
 
-def install_rootfs(rootfs_url, local_path):
-    rootfs_path = os.path.join(local_path, "rootfs")
+    def abort(self, tmp):
+        tmp.close()
+        os.unlink(tmp.name)
 
-    logging.debug("Retrieving \"%s\"...", rootfs_url)
-    (rootfs_filename, _) = urllib.request.urlretrieve(rootfs_url)
-    logging.debug("Extracting to \"%s\"...", rootfs_path)
-    with tarfile.open(rootfs_filename, mode="r:xz") as tarball:
-        tarball.extractall(rootfs_path)
-    urllib.request.urlcleanup()
+    def add(self, url, tmp_path, digest, pin=False):
+        """
+        Move the downloaded archive at `tmp_path` into the cache as the
+        contents of `url` and return its new path. The archive is pinned if
+        `pin` is set or the previous archive for `url` was pinned.
+        """
+        path = self.blob_path(digest)
+        os.rename(tmp_path, path)
+
+        index = self.index.lock_and_read()
+        now = time.time()
+        pin = pin or index.get(url, {}).get('pinned', False)
+        index[url] = {
+            'digest': digest,
+            'size': os.path.getsize(path),
+            'added': now,
+            'last_used': now,
+        }
+        if pin:
+            index[url]['pinned'] = True
+        self._evict(index, self.max_size, keep=url)
+        self.index.unlock_and_write(index)
+        return path
+
+    def list(self):
+        index = self.index.lock_and_read()
+        self.index.unlock_and_discard()
+        return index
+
+    def unpin(self, urls):
+        """Let the archives for `urls` be evicted again."""
+        index = self.index.lock_and_read()
+        for url in urls:
+            if url in index:
+                index[url].pop('pinned', None)
+        self.index.unlock_and_write(index)
+
+    def discard(self, digest):
+        """Remove the archive with the given digest from the cache."""
+        index = self.index.lock_and_read()
+        for url in [url for url in index if index[url]['digest'] == digest]:
+            del index[url]
+        try:
+            os.unlink(self.blob_path(digest))
+        except FileNotFoundError:
+            pass
+        self.index.unlock_and_write(index)
 
-def create_spec_file(name, local_path, command, capabilities):
-    spec_path = os.path.join(local_path, "config.json")
-    logging.debug("Creating spec file \"%s\"...", spec_path)
-    subprocess.run(["runc", "spec"], cwd=local_path, check=True)
-    spec_file = open(spec_path, 'r+')
-    spec = json.load(spec_file)
+    def prune(self, max_size):
+        """
+        Evict least recently used archives until those which are not pinned
+        take no more than `max_size` bytes. Returns the number of bytes freed.
+        """
+        index = self.index.lock_and_read()
+        freed = self._evict(index, max_size)
+        self.index.unlock_and_write(index)
+
+        remove_stale_tmp(self.blobs_path)
+        return freed
+
+    def _evict(self, index, max_size, keep=None):
+        total = sum(entry['size'] for entry in index.values()
+                    if not entry.get('pinned'))
+        freed = 0
+        lru = sorted((url for url in index if not index[url].get('pinned')),
+                     key=lambda url: index[url]['last_used'])
+        for url in lru:
+            if total <= max_size:
+                break
+            if url == keep:
+                continue
+            entry = index.pop(url)
+            total -= entry['size']
+            # Several URLs may share one archive
+            if any(e['digest'] == entry['digest'] for e in index.values()):
+                continue
+            logging.debug("Evicting \"%s\" from cache", url)
+            try:
+                os.unlink(self.blob_path(entry['digest']))
+                freed += entry['size']
+            except FileNotFoundError:
+                pass
+        return freed
+
+def detect_compression(head):
+    """
+    Return the compression format of an archive given its first bytes, or None
+    for an uncompressed tar archive.
+    """
+    if head.startswith(b"\xfd7zXZ\x00"):
+        return "xz"
+    if head.startswith(b"\x28\xb5\x2f\xfd"):
+        return "zstd"
+    if head.startswith(b"\x04\x22\x4d\x18"):
+        return "lz4"
+    if head.startswith(b"\x1f\x8b"):
+        return "gz"
+    if head.startswith(b"BZh"):
+        return "bz2"
+    return None
+
+def decompressor_command(compression):
+    """
+    Return the command line of the best available external decompressor for
+    the given format, preferring tools which can use multiple cores, or None if
+    no suitable tool is installed.
+    """
+    import shutil
+    jobs = str(os.cpu_count() or 1)
+    candidates = {
+        # xz 5.4 and later decompress multi-block archives in parallel
+        'xz': [["xz", "-d", "-c", "-T", jobs]],
+        'zstd': [["pzstd", "-d", "-c", "-p", jobs], ["zstd", "-d", "-c"]],
+        'lz4': [["lz4", "-d", "-c"]],
+        'gz': [["pigz", "-d", "-c", "-p", jobs], ["gzip", "-d", "-c"]],
+        'bz2': [["lbzip2", "-d", "-c", "-n", jobs], ["bzip2", "-d", "-c"]],
+    }
+    for command in candidates.get(compression, []):
+        if shutil.which(command[0]):
+            return command
+    return None
+
+class ChainReader:
+    """File-like object which returns `head` followed by the data in `fileobj`."""
+
+    def __init__(self, head, fileobj):
+        self.head = head
+        self.fileobj = fileobj
+
+    def read(self, size=-1):
+        if not self.head:
+            return self.fileobj.read(size)
+        if size < 0:
+            data = self.head + self.fileobj.read()
+            self.head = b""
+            return data
+        data = self.head[:size]
+        self.head = self.head[size:]
+        return data
+
+def extract_rootfs(fileobj, rootfs_path):
+    """
+    Extract the tar archive read from `fileobj` into `rootfs_path`. The archive
+    may be uncompressed or compressed with xz, zstd, lz4, gzip or bzip2; the
+    format is detected from its contents. Decompression is done by an external
+    tool where possible so that it runs in parallel with extraction and, for
+    multi-block xz and pzstd archives, across several cores.
+    """
+    with TRACER.span("extract") as span:
+        (compression, files) = _extract_rootfs(fileobj, rootfs_path)
+        span.set(compression=compression or "none", files=files)
+
+def _extract_rootfs(fileobj, rootfs_path):
+    """Extract an archive, returning its compression and number of members."""
+    import subprocess
+    import tarfile
+    # The tar magic is at offset 257 so read enough to spot it
+    head = b""
+    while len(head) < 512:
+        data = fileobj.read(512 - len(head))
+        if not data:
+            break
+        head += data
+    compression = detect_compression(head)
+    stream = ChainReader(head, fileobj)
+
+    command = decompressor_command(compression)
+    if command is None:
+        if compression not in (None, "xz", "gz", "bz2"):
+            raise ValueError("No decompressor available for %s archives"
+                             % compression)
+        logging.debug("Extracting %s archive in-process...",
+                      compression or "uncompressed")
+        mode = "r|" + (compression or "")
+        with tarfile.open(fileobj=stream, mode=mode) as tarball:
+            tarball.extractall(rootfs_path)
+        return (compression, len(tarball.members))
+
+    logging.debug("Extracting %s archive using \"%s\"...", compression,
+                  " ".join(command))
+    proc = subprocess.Popen(command, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE)
+    feed_errors = []
+
+    def feed():
+        try:
+            for chunk in iter(lambda: stream.read(1 << 20), b""):
+                proc.stdin.write(chunk)
+        except BrokenPipeError:
+            pass
+        except Exception as err: # pylint: disable=broad-except
+            feed_errors.append(err)
+        finally:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    feeder = threading.Thread(target=feed)
+    feeder.start()
+    try:
+        with tarfile.open(fileobj=proc.stdout, mode="r|") as tarball:
+            tarball.extractall(rootfs_path)
+        files = len(tarball.members)
+        # Consume any padding after the end of the tar stream
+        while proc.stdout.read(1 << 20):
+            pass
+    except BaseException:
+        proc.kill()
+        raise
+    finally:
+        feeder.join()
+        proc.stdout.close()
+        proc.wait()
+
+    if feed_errors:
+        raise feed_errors[0]
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, command)
+    return (compression, files)
+
+def check_digest(url, digest, expected_digest):
+    """
+    Raise ValueError if `expected_digest` is given and differs from the digest
+    of the data fetched from `url`.
+    """
+    if expected_digest is not None and digest != expected_digest.lower():
+        raise ValueError("SHA-256 digest of \"%s\" is %s, expected %s"
+                         % (url, digest, expected_digest))
+
+def install_rootfs(rootfs_url, rootfs_path, cache, downloader,
+                   expected_digest=None):
+    """
+    Extract the rootfs archive at `rootfs_url` into `rootfs_path`, using or
+    filling `cache` as appropriate. Returns the SHA-256 digest of the archive.
+    If `expected_digest` is given, the archive is checked as it is downloaded
+    and ValueError is raised on a mismatch, with nothing extracted or cached.
+    """
+    import shutil
+    import tempfile
+    cached_path = cache.lookup(rootfs_url, expected_digest) \
+        if cache.enabled else None
+    if cached_path:
+        logging.debug("Extracting cached \"%s\" to \"%s\"...", cached_path,
+                      rootfs_path)
+        with open(cached_path, 'rb') as archive:
+            extract_rootfs(archive, rootfs_path)
+        return os.path.basename(cached_path)
+
+    if downloader.segments > 1:
+        # Segmented downloads arrive out of order so cannot be streamed
+        if cache.enabled:
+            archive_path = cache.fetch(rootfs_url, downloader, expected_digest)
+            with open(archive_path, 'rb') as archive:
+                extract_rootfs(archive, rootfs_path)
+            return os.path.basename(archive_path)
+        with tempfile.TemporaryFile() as archive:
+            digest = downloader.download(rootfs_url, archive)
+            check_digest(rootfs_url, digest, expected_digest)
+            archive.seek(0)
+            extract_rootfs(archive, rootfs_path)
+        return digest
+
+    # Extract the archive as it is downloaded rather than writing it out first,
+    # so only the rootfs (plus the cached archive, if enabled) hits the disk
+    logging.debug("Streaming \"%s\" to \"%s\"...", rootfs_url, rootfs_path)
+    tmp = cache.begin() if cache.enabled else None
+    try:
+        with TRACER.span("stream", url=rootfs_url) as span, \
+                downloader.open(rootfs_url) as response:
+            reader = HashingReader(response, tmp)
+            extract_rootfs(reader, rootfs_path)
+            # Read any data after the end of the archive so that the cached
+            # copy and digest are complete
+            reader.drain()
+            span.set(bytes=reader.size)
+        # The digest is only known once the whole archive has streamed through
+        # the extractor, so discard the extracted files on a mismatch
+        digest = reader.digest.hexdigest()
+        check_digest(rootfs_url, digest, expected_digest)
+    except BaseException:
+        if tmp:
+            cache.abort(tmp)
+        if expected_digest is not None:
+            shutil.rmtree(rootfs_path, ignore_errors=True)
+        raise
+
+    if tmp:
+        tmp.close()
+        cache.add(rootfs_url, tmp.name, digest)
+    return digest
+
+class LayerStore:
+    """
+    Store of image rootfs trees which are shared read-only between guests as the
+    lower layer of an overlay mount. Each layer is extracted once into a
+    directory named by the SHA-256 digest of its archive and the index maps
+    each source URL to the digest of the layer extracted from it.
+    """
+
+    def __init__(self, layers_path):
+        self.layers_path = layers_path
+        self.index = LockedJsonFile(os.path.join(layers_path, "index"))
+
+    def layer_path(self, digest):
+        return os.path.join(self.layers_path, digest)
+
+    def manifest_path(self, digest):
+        """Return the path of the manifest of the files in layer `digest`."""
+        return os.path.join(self.layers_path, digest + ".manifest.json")
+
+    def lookup(self, url):
+        """Return the digest of the layer extracted from `url` or None."""
+        index = self.index.lock_and_read()
+        entry = index.get(url)
+        if entry is None or not os.path.isdir(self.layer_path(entry['digest'])):
+            self.index.unlock_and_discard()
+            return None
+
+        entry['last_used'] = time.time()
+        self.index.unlock_and_write(index)
+        return entry['digest']
+
+    @traced("install_layer")
+    def install(self, url, cache, downloader, expected_digest=None):
+        """
+        Return the digest of the layer for `url`, extracting it into the store
+        first if needed. If `expected_digest` is given, the layer must have been
+        extracted from an archive with that digest.
+        """
+        import shutil
+        import tempfile
+        digest = self.lookup(url)
+        if digest and expected_digest is not None and \
+                digest != expected_digest.lower():
+            logging.debug("Layer for \"%s\" is out of date", url)
+            digest = None
+        if not digest and expected_digest is not None and \
+                os.path.isdir(self.layer_path(expected_digest.lower())):
+            # The same archive was already extracted from another URL
+            digest = expected_digest.lower()
+            self.register(url, digest)
+        if digest:
+            logging.debug("Using existing layer \"%s\"", digest)
+            if not os.path.exists(self.manifest_path(digest)):
+                # Extracted by an older version which did not record one
+                write_json_file(self.manifest_path(digest),
+                                tree_manifest(self.layer_path(digest)))
+            return digest
+
+        os.makedirs(self.layers_path, exist_ok=True)
+        tmp_path = tempfile.mkdtemp(dir=self.layers_path, prefix="tmp")
+        try:
+            digest = install_rootfs(url, tmp_path, cache, downloader,
+                                    expected_digest)
+            # Recorded for verify, as the layer has no room for it
+            write_json_file(self.manifest_path(digest), tree_manifest(tmp_path))
+            try:
+                os.rename(tmp_path, self.layer_path(digest))
+            except OSError:
+                # Another command extracted the same archive at the same time
+                if not os.path.isdir(self.layer_path(digest)):
+                    raise
+                shutil.rmtree(tmp_path)
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+
+        self.register(url, digest)
+        return digest
+
+    def register(self, url, digest):
+        """Record that the layer `digest` holds the contents of `url`."""
+        index = self.index.lock_and_read()
+        now = time.time()
+        index[url] = {
+            'digest': digest,
+            'added': now,
+            'last_used': now,
+        }
+        self.index.unlock_and_write(index)
+
+    def prune(self, keep):
+        """
+        Remove all layers whose digests are not in `keep`. Returns the number
+        of layers removed.
+        """
+        import shutil
+        index = self.index.lock_and_read()
+        for url in list(index):
+            if index[url]['digest'] not in keep:
+                del index[url]
+
+        count = 0
+        if os.path.isdir(self.layers_path):
+            for fname in os.listdir(self.layers_path):
+                if fname in keep or fname == "index" or fname.startswith("tmp"):
+                    continue
+                if fname.endswith(".manifest.json"):
+                    if fname[:-len(".manifest.json")] not in keep:
+                        os.unlink(os.path.join(self.layers_path, fname))
+                    continue
+                logging.debug("Removing unused layer \"%s\"", fname)
+                shutil.rmtree(self.layer_path(fname))
+                count += 1
+        self.index.unlock_and_write(index)
+
+        remove_stale_tmp(self.layers_path)
+        return count
+
+def overlayfs_supported():
+    try:
+        with open("/proc/filesystems") as filesystems:
+            return any(line.split()[-1] == "overlay" for line in filesystems
+                       if line.strip())
+    except OSError:
+        return False
+
+# ioctl request to share the data blocks of one file with another (reflink)
+FICLONE = 0x40049409
+
+# renameat2() arguments to atomically swap two paths
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
+
+def exchange_paths(path_a, path_b):
+    """
+    Atomically swap the entries at `path_a` and `path_b`. Returns False if the
+    C library, kernel or filesystem does not support this.
+    """
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        renameat2 = libc.renameat2
+    except (ImportError, AttributeError, OSError):
+        return False
+    if renameat2(AT_FDCWD, os.fsencode(path_a), AT_FDCWD, os.fsencode(path_b),
+                 RENAME_EXCHANGE) == 0:
+        return True
+    err = ctypes.get_errno()
+    if err in (errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+        return False
+    raise OSError(err, os.strerror(err), path_a, None, path_b)
+
+def recover_rootfs(guest_path):
+    """
+    Restore the rootfs of a copy guest whose upgrade was interrupted after
+    moving the old rootfs aside into its staging directory but before moving
+    the new one into place.
+    """
+    import shutil
+    rootfs_path = os.path.join(guest_path, "rootfs")
+    if os.path.lexists(rootfs_path) or not os.path.isdir(guest_path):
+        return
+    for fname in sorted(os.listdir(guest_path)):
+        old_path = os.path.join(guest_path, fname, "old")
+        if fname.startswith("tmp") and os.path.isdir(old_path):
+            logging.warning("Restoring the rootfs of \"%s\" left by an "
+                            "interrupted upgrade", guest_path)
+            os.rename(old_path, rootfs_path)
+            shutil.rmtree(os.path.join(guest_path, fname), ignore_errors=True)
+            return
+
+def clone_tree(src, dst, unchanged_before=None):
+    """
+    Copy the directory tree `src` to a new directory `dst`, preserving
+    ownership, permissions, timestamps, extended attributes, hardlinks and
+    special files. Regular files are reflinked where the filesystem supports
+    it. Otherwise, files last modified before the `unchanged_before` timestamp
+    are hardlinked to the original and any others are copied. Returns a dict
+    counting the files which were reflinked, hardlinked and copied.
+    """
+    import shutil
+    counts = {'reflinked': 0, 'hardlinked': 0, 'copied': 0}
+    reflink = [True]
+    inodes = {}
+
+    def clone_file(src_path, dst_path, st):
+        if reflink[0]:
+            try:
+                with open(src_path, 'rb') as fsrc, open(dst_path, 'wb') as fdst:
+                    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                counts['reflinked'] += 1
+                return True
+            except OSError as err:
+                if err.errno not in (errno.EOPNOTSUPP, errno.EXDEV,
+                                     errno.EINVAL, errno.ENOTTY):
+                    raise
+                logging.debug("Reflinks not supported: %s", err)
+                reflink[0] = False
+                os.unlink(dst_path)
+        if unchanged_before is not None and st.st_mtime < unchanged_before:
+            os.link(src_path, dst_path)
+            counts['hardlinked'] += 1
+            return False
+        shutil.copyfile(src_path, dst_path)
+        counts['copied'] += 1
+        return True
+
+    def copy_entry(src_path, dst_path, st):
+        if stat.S_ISDIR(st.st_mode):
+            os.mkdir(dst_path, 0o700)
+            for entry in os.scandir(src_path):
+                copy_entry(entry.path, os.path.join(dst_path, entry.name),
+                           entry.stat(follow_symlinks=False))
+        elif stat.S_ISLNK(st.st_mode):
+            os.symlink(os.readlink(src_path), dst_path)
+        elif stat.S_ISREG(st.st_mode):
+            if st.st_nlink > 1 and st.st_ino in inodes:
+                os.link(inodes[st.st_ino], dst_path)
+                return
+            inodes[st.st_ino] = dst_path
+            if not clone_file(src_path, dst_path, st):
+                return
+        elif stat.S_ISSOCK(st.st_mode):
+            return
+        else:
+            # Device nodes, fifos and overlayfs whiteouts
+            os.mknod(dst_path, st.st_mode, st.st_rdev)
+        os.chown(dst_path, st.st_uid, st.st_gid, follow_symlinks=False)
+        shutil.copystat(src_path, dst_path, follow_symlinks=False)
+
+    with TRACER.span("clone_tree") as span:
+        copy_entry(src, dst, os.lstat(src))
+        span.set(files=sum(counts.values()), **counts)
+    return counts
+
+def hash_file(path):
+    """Return the SHA-256 digest of the file at `path`."""
+    with open(path, 'rb') as fileobj:
+        reader = HashingReader(fileobj)
+        reader.drain()
+    return reader.digest.hexdigest()
+
+def hash_files(paths):
+    """
+    Return a list of the SHA-256 digests of the files at `paths`, with None
+    for files which do not exist, hashing files in parallel on all CPUs.
+    """
+    import concurrent.futures
+
+    def hash_existing_file(path):
+        try:
+            return hash_file(path)
+        except FileNotFoundError:
+            return None
+
+    # hashlib releases the GIL while hashing so threads use every CPU
+    jobs = os.cpu_count() or 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(hash_existing_file, paths))
+
+def tree_manifest(rootfs_path):
+    """
+    Return a manifest of the tree at `rootfs_path` in the format read by
+    upgrade_guest and verify.
+    """
+    entries = {}
+    files = []
+    for (dir_path, dnames, fnames) in os.walk(rootfs_path):
+        for fname in sorted(dnames + fnames):
+            full_path = os.path.join(dir_path, fname)
+            path = os.path.relpath(full_path, rootfs_path)
+            st = os.lstat(full_path)
+            entry = {'mode': stat.S_IMODE(st.st_mode), 'uid': st.st_uid,
+                     'gid': st.st_gid}
+            if stat.S_ISDIR(st.st_mode):
+                entry['type'] = 'dir'
+            elif stat.S_ISLNK(st.st_mode):
+                entry['type'] = 'symlink'
+                entry['target'] = os.readlink(full_path)
+            elif stat.S_ISREG(st.st_mode):
+                entry.update(type='file', size=st.st_size)
+                files.append(path)
+            else:
+                # Device nodes and fifos are created by the guest itself
+                continue
+            entries[path] = entry
+
+    digests = hash_files([os.path.join(rootfs_path, path) for path in files])
+    for (path, digest) in zip(files, digests):
+        if digest is None:
+            # Deleted since the tree was walked
+            del entries[path]
+        else:
+            entries[path]['sha256'] = digest
+    return {'version': 1, 'entries': entries}
+
+def make_manifest(rootfs_path, output_path):
+    """
+    Write a manifest of the tree at `rootfs_path` for use by upgrade_guest to
+    `output_path`/manifest.json. The content of each regular file is stored
+    once under `output_path`/objects, named by its SHA-256 digest. Returns the
+    manifest.
+    """
+    import shutil
+    manifest = tree_manifest(rootfs_path)
+    for (path, entry) in manifest['entries'].items():
+        if entry['type'] != 'file':
+            continue
+        object_path = os.path.join(output_path, "objects", entry['sha256'][:2],
+                                   entry['sha256'])
+        if not os.path.exists(object_path):
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            shutil.copyfile(os.path.join(rootfs_path, path), object_path)
+
+    write_json_file(os.path.join(output_path, "manifest.json"), manifest)
+    return manifest
+
+def in_writable_path(path, writable):
+    return any(path == prefix or path.startswith(prefix + "/")
+               for prefix in writable)
+
+def manifest_missing_objects(manifest, rootfs_path, writable, previous=None,
+                             previous_time=0):
+    """
+    Compare the tree at `rootfs_path` with `manifest` and return a dict mapping
+    the digest of each file which must be fetched to its size. Files matching
+    the `previous` manifest which have not been modified since
+    `previous_time` are assumed unchanged, others are hashed if their size
+    matches. Existing files in `writable` paths are always kept.
+    """
+    missing = {}
+    previous_entries = previous['entries'] if previous else {}
+    for (path, entry) in manifest['entries'].items():
+        if entry['type'] != 'file':
+            continue
+        try:
+            st = os.lstat(os.path.join(rootfs_path, path))
+        except FileNotFoundError:
+            missing[entry['sha256']] = entry['size']
+            continue
+        if in_writable_path(path, writable):
+            continue
+        if stat.S_ISREG(st.st_mode) and st.st_size == entry['size']:
+            previous_entry = previous_entries.get(path, {})
+            if previous_entry.get('sha256') == entry['sha256'] and \
+                    st.st_mtime < previous_time:
+                continue
+            if hash_file(os.path.join(rootfs_path, path)) == entry['sha256']:
+                continue
+        missing[entry['sha256']] = entry['size']
+    return missing
+
+def apply_manifest(manifest, rootfs_path, objects_path, writable):
+    """
+    Update the tree at `rootfs_path` to match `manifest`, taking the content of
+    changed files from `objects_path`, which holds the objects listed by
+    manifest_missing_objects() named by their digests. Existing files in
+    `writable` paths are kept. Files are replaced rather than modified in
+    place, so hardlinks to the tree's files elsewhere are left unchanged.
+    """
+    import shutil
+    entries = manifest['entries']
+    as_root = os.geteuid() == 0
+
+    def remove(full_path):
+        if os.path.isdir(full_path) and not os.path.islink(full_path):
+            shutil.rmtree(full_path)
+        else:
+            os.unlink(full_path)
+
+    # Remove everything which is no longer in the image, deepest first
+    for (dir_path, dnames, fnames) in os.walk(rootfs_path, topdown=False):
+        for fname in dnames + fnames:
+            full_path = os.path.join(dir_path, fname)
+            path = os.path.relpath(full_path, rootfs_path)
+            if path in entries or in_writable_path(path, writable):
+                continue
+            if os.path.isdir(full_path) and not os.path.islink(full_path):
+                # Directories holding writable paths are kept
+                if not os.listdir(full_path):
+                    os.rmdir(full_path)
+            else:
+                os.unlink(full_path)
+
+    # Parents sort before their children
+    for path in sorted(entries):
+        entry = entries[path]
+        full_path = os.path.join(rootfs_path, path)
+        exists = os.path.lexists(full_path)
+        if exists and in_writable_path(path, writable):
+            continue
+        st = os.lstat(full_path) if exists else None
+
+        if entry['type'] == 'symlink':
+            if st is not None:
+                if stat.S_ISLNK(st.st_mode) and \
+                        os.readlink(full_path) == entry['target']:
+                    continue
+                remove(full_path)
+            os.symlink(entry['target'], full_path)
+            if as_root:
+                os.chown(full_path, entry['uid'], entry['gid'],
+                         follow_symlinks=False)
+            continue
+
+        if entry['type'] == 'dir':
+            if st is not None and not stat.S_ISDIR(st.st_mode):
+                remove(full_path)
+                st = None
+            if st is None:
+                os.mkdir(full_path, 0o700)
+                st = os.lstat(full_path)
+        else:
+            object_path = os.path.join(objects_path, entry['sha256'])
+            if os.path.exists(object_path):
+                if st is not None:
+                    remove(full_path)
+                shutil.copyfile(object_path, full_path)
+                st = os.lstat(full_path)
+            elif st.st_nlink > 1 and (
+                    stat.S_IMODE(st.st_mode) != entry['mode'] or
+                    (as_root and (st.st_uid, st.st_gid) !=
+                     (entry['uid'], entry['gid']))):
+                # Copy the file rather than changing a hardlinked original
+                shutil.copyfile(full_path, full_path + ".tmp")
+                os.rename(full_path + ".tmp", full_path)
+                st = os.lstat(full_path)
+
+        if stat.S_IMODE(st.st_mode) != entry['mode']:
+            os.chmod(full_path, entry['mode'])
+        if as_root and (st.st_uid, st.st_gid) != (entry['uid'], entry['gid']):
+            os.chown(full_path, entry['uid'], entry['gid'])
+
+def reset_upper_dir(upper_path, writable):
+    """
+    Remove everything from the overlay upper directory `upper_path` except the
+    guest's changes under `writable` paths, including the whiteouts and opaque
+    directories which hide files of the lower layer.
+    """
+    for (dir_path, dnames, fnames) in os.walk(upper_path, topdown=False):
+        for fname in dnames + fnames:
+            full_path = os.path.join(dir_path, fname)
+            path = os.path.relpath(full_path, upper_path)
+            if in_writable_path(path, writable):
+                continue
+            if os.path.isdir(full_path) and not os.path.islink(full_path):
+                if os.listdir(full_path):
+                    # Only kept for the writable paths below it, so it must not
+                    # hide the rest of the lower directory
+                    try:
+                        os.removexattr(full_path, "trusted.overlay.opaque",
+                                       follow_symlinks=False)
+                    except OSError as err:
+                        if err.errno not in (errno.ENODATA, errno.ENOTSUP):
+                            raise
+                else:
+                    os.rmdir(full_path)
+            else:
+                os.unlink(full_path)
+
+def write_text_file(path, text):
+    """
+    Write `text` to `path`, replacing any existing file atomically so that
+    readers never see a partially written file.
+    """
+    import tempfile
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path),
+                                     prefix=".tmp", delete=False) as tmp:
+        tmp.write(text)
+    os.chmod(tmp.name, 0o644)
+    os.replace(tmp.name, path)
+
+def write_json_file(path, data):
+    write_text_file(path, json.dumps(data, indent=4) + "\n")
+
+class SpecTemplate:
+    """
+    Base OCI runtime spec as generated by 'runc spec'. The spec is cached on
+    disk alongside the path, size and modification time of the runc binary
+    which generated it, and is only generated again when runc changes.
+    """
+
+    def __init__(self, cache_path):
+        self.template_path = os.path.join(cache_path, "spec-template.json")
+        self.key = None
+        self.spec_json = None
+
+    def _runc_key(self):
+        import shutil
+        runc_path = shutil.which("runc")
+        if runc_path is None:
+            raise FileNotFoundError(errno.ENOENT, "runc not found in PATH")
+        st = os.stat(runc_path)
+        return [runc_path, st.st_size, st.st_mtime_ns]
+
+    def get(self, refresh=False):
+        """
+        Return a new copy of the base spec, which callers may modify. If
+        `refresh` is set, the cached spec is ignored and generated again.
+        """
+        key = self._runc_key()
+        if refresh or key != self.key:
+            entry = None
+            if not refresh:
+                try:
+                    with open(self.template_path) as f:
+                        entry = json.load(f)
+                except (OSError, ValueError):
+                    pass
+            if entry is None or entry['key'] != key:
+                entry = {'key': key, 'spec': self._generate()}
+                os.makedirs(os.path.dirname(self.template_path), exist_ok=True)
+                write_json_file(self.template_path, entry)
+            self.spec_json = json.dumps(entry['spec'])
+            self.key = key
+        return json.loads(self.spec_json)
+
+    @traced("runc_spec")
+    def _generate(self):
+        import subprocess
+        import tempfile
+        logging.debug("Generating spec template with 'runc spec'...")
+        with tempfile.TemporaryDirectory(prefix="possumcmd-spec-") as tmp_path:
+            subprocess.run(["runc", "spec"], cwd=tmp_path, check=True)
+            with open(os.path.join(tmp_path, "config.json")) as f:
+                return json.load(f)
+
+def build_spec(spec, name, command, capabilities):
+    """Adapt the base spec from SpecTemplate.get() for the given guest."""
+    import shlex
 
     # Add netns hook
     if not "hooks" in spec:
@@ -97,25 +1746,469 @@ def create_spec_file(name, local_path, command, capabilities):
         "source": "tmpfs"
         })
 
-    # Write back the updated spec
-    spec_file.seek(0)
-    spec_file.truncate()
-    json.dump(spec, spec_file, indent=4)
-    spec_file.write("\n")
-    spec_file.close()
+    return spec
+
+@traced("create_spec")
+def create_spec_file(name, local_path, command, capabilities, template):
+    spec_path = os.path.join(local_path, "config.json")
+    logging.debug("Creating spec file \"%s\"...", spec_path)
+    spec = build_spec(template.get(), name, command, capabilities)
+    write_json_file(spec_path, spec)
+
+# Files read by CgroupReader. For each statistic the first file which exists
+# is used, as (controller, file name) with an empty controller for cgroup v2
+CGROUP_FILES = [
+    [('', 'cpu.stat'), ('cpuacct', 'cpuacct.usage')],
+    [('cpuacct', 'cpuacct.stat')],
+    [('', 'memory.current'), ('memory', 'memory.usage_in_bytes')],
+    [('', 'memory.max'), ('memory', 'memory.limit_in_bytes')],
+    [('', 'pids.current'), ('pids', 'pids.current')],
+    [('', 'io.stat'), ('blkio', 'blkio.throttle.io_service_bytes')],
+]
+
+# Values at or above this in memory limit files mean there is no limit
+CGROUP_UNLIMITED = 1 << 60
+
+class CgroupReader:
+    """
+    Reads the resource usage of processes directly from cgroupfs, supporting
+    both cgroup v1 and v2. The cgroup files of each process are found and
+    opened once, then re-read with pread() on later calls so that repeated
+    reads cost one system call per file.
+    """
+
+    def __init__(self):
+        self.mounts = None
+        self.files = {}
+
+    def _find_mounts(self):
+        """Return a dict mapping each controller to its mount point."""
+        mounts = {}
+        with open("/proc/self/mounts") as mounts_file:
+            for line in mounts_file:
+                (_, mount_point, fs_type, options) = line.split()[:4]
+                if fs_type == "cgroup2":
+                    mounts.setdefault('', mount_point)
+                elif fs_type == "cgroup":
+                    for option in options.split(","):
+                        mounts.setdefault(option, mount_point)
+        return mounts
+
+    def _open_files(self, pid):
+        if self.mounts is None:
+            self.mounts = self._find_mounts()
+
+        paths = {}
+        with open("/proc/%d/cgroup" % pid) as cgroup_file:
+            for line in cgroup_file:
+                (_, controllers, path) = line.rstrip("\n").split(":", 2)
+                for controller in controllers.split(",") if controllers else [""]:
+                    paths[controller] = path.lstrip("/")
+
+        files = {}
+        for candidates in CGROUP_FILES:
+            for (controller, fname) in candidates:
+                if controller not in paths or controller not in self.mounts:
+                    continue
+                path = os.path.join(self.mounts[controller], paths[controller],
+                                    fname)
+                try:
+                    files[fname] = os.open(path, os.O_RDONLY)
+                    break
+                except OSError:
+                    continue
+        return files
+
+    def read(self, pid):
+        """
+        Return a dict of the available statistics for the cgroup of `pid`.
+        CPU times are in seconds and memory and IO sizes in bytes.
+        """
+        if pid not in self.files:
+            self.files[pid] = self._open_files(pid)
+
+        stats = {}
+        for (fname, fd) in self.files[pid].items():
+            data = os.pread(fd, 65536, 0).decode('utf-8')
+            stats.update(self._parse(fname, data))
+        return stats
+
+    def close(self, pid):
+        """Close the files held for `pid`."""
+        for fd in self.files.pop(pid, {}).values():
+            os.close(fd)
+
+    def forget(self, pids):
+        """Close the files held for all processes not listed in `pids`."""
+        for pid in list(self.files):
+            if pid not in pids:
+                self.close(pid)
+
+    def _parse(self, fname, data):
+        if fname == 'cpu.stat':
+            fields = dict(line.split() for line in data.splitlines())
+            return {'cpu_usage': int(fields['usage_usec']) / 1e6,
+                    'cpu_user': int(fields['user_usec']) / 1e6,
+                    'cpu_system': int(fields['system_usec']) / 1e6}
+        if fname == 'cpuacct.usage':
+            return {'cpu_usage': int(data) / 1e9}
+        if fname == 'cpuacct.stat':
+            fields = dict(line.split() for line in data.splitlines())
+            ticks = os.sysconf('SC_CLK_TCK')
+            return {'cpu_user': int(fields['user']) / ticks,
+                    'cpu_system': int(fields['system']) / ticks}
+        if fname in ('memory.current', 'memory.usage_in_bytes'):
+            return {'memory_usage': int(data)}
+        if fname in ('memory.max', 'memory.limit_in_bytes'):
+            if data.strip() == "max" or int(data) >= CGROUP_UNLIMITED:
+                return {}
+            return {'memory_limit': int(data)}
+        if fname == 'pids.current':
+            return {'pids': int(data)}
+        if fname == 'io.stat':
+            # One line per device as "MAJ:MIN rbytes=N wbytes=N ..."
+            stats = {'io_read': 0, 'io_write': 0}
+            for line in data.splitlines():
+                fields = dict(field.split("=", 1) for field in line.split()[1:])
+                stats['io_read'] += int(fields.get('rbytes', 0))
+                stats['io_write'] += int(fields.get('wbytes', 0))
+            return stats
+        if fname == 'blkio.throttle.io_service_bytes':
+            # One line per device and operation as "MAJ:MIN Read N"
+            stats = {'io_read': 0, 'io_write': 0}
+            for line in data.splitlines():
+                fields = line.split()
+                if len(fields) == 3 and fields[1] in ('Read', 'Write'):
+                    stats['io_' + fields[1].lower()] += int(fields[2])
+            return stats
+        return {}
+
+# Prometheus metrics reported by the 'metrics' command for CgroupReader
+# statistics, as (statistic, metric name, metric type, help text)
+GUEST_METRICS = [
+    ('cpu_usage', 'possum_guest_cpu_seconds_total', 'counter',
+     "Total CPU time used by the guest"),
+    ('cpu_user', 'possum_guest_cpu_user_seconds_total', 'counter',
+     "CPU time used by the guest in user mode"),
+    ('cpu_system', 'possum_guest_cpu_system_seconds_total', 'counter',
+     "CPU time used by the guest in kernel mode"),
+    ('memory_usage', 'possum_guest_memory_usage_bytes', 'gauge',
+     "Memory used by the guest"),
+    ('memory_limit', 'possum_guest_memory_limit_bytes', 'gauge',
+     "Memory limit of the guest"),
+    ('pids', 'possum_guest_pids', 'gauge',
+     "Number of processes in the guest"),
+    ('io_read', 'possum_guest_io_read_bytes_total', 'counter',
+     "Bytes read from block devices by the guest"),
+    ('io_write', 'possum_guest_io_write_bytes_total', 'counter',
+     "Bytes written to block devices by the guest"),
+]
+
+def rotate_log(path, max_size, count):
+    """
+    Rotate the log file at `path` once it has grown beyond `max_size` bytes.
+    As the guest writes to the file directly, its contents are copied to a new
+    segment and the file is then truncated in place. Up to `count` segments
+    are kept as "log.1.gz", "log.2.gz" and so on, newest first, each
+    compressed with gzip in a background thread. Output which the guest writes
+    while the file is being copied is lost, and the file grows beyond
+    `max_size` until it is next rotated.
+    """
+    import shutil
+    try:
+        logfile = open(path, "rb+")
+    except FileNotFoundError:
+        return
+    try:
+        # The lock is held until the segment has been compressed, so flock()
+        # is used as it is not released when another thread closes the file
+        fcntl.flock(logfile, fcntl.LOCK_EX)
+        if os.fstat(logfile.fileno()).st_size <= max_size:
+            return
+        segment_path = path + ".1"
+        if count > 0:
+            if os.path.exists(segment_path):
+                # Left behind by an interrupted compression
+                compress_log_segment(segment_path)
+            for i in range(count - 1, 0, -1):
+                try:
+                    os.rename("%s.%d.gz" % (path, i),
+                              "%s.%d.gz" % (path, i + 1))
+                except FileNotFoundError:
+                    pass
+            with open(segment_path, "wb") as segment:
+                shutil.copyfileobj(logfile, segment)
+        logfile.truncate(0)
+        if count > 0:
+            # Not a daemon thread, so that a command which rotated a log only
+            # exits once the segment is compressed
+            threading.Thread(target=compress_log_segment,
+                             args=(segment_path, logfile)).start()
+            logfile = None
+    finally:
+        if logfile is not None:
+            logfile.close()
+
+def compress_log_segment(segment_path, logfile=None):
+    """
+    Replace the log segment at `segment_path` with a copy compressed with
+    gzip, then close `logfile` if given to release its lock.
+    """
+    import gzip
+    import shutil
+    try:
+        with open(segment_path, "rb") as src, \
+                gzip.open(segment_path + ".gz.tmp", "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.rename(segment_path + ".gz.tmp", segment_path + ".gz")
+        os.unlink(segment_path)
+    except OSError as err:
+        # Keep the uncompressed segment rather than losing it
+        logging.warning("Failed to compress \"%s\": %s", segment_path, err)
+    finally:
+        if logfile is not None:
+            logfile.close()
+
+def tail_offset(fileobj, lines):
+    """
+    Return the offset of the start of the last `lines` lines of `fileobj`,
+    reading blocks backwards from the end of the file.
+    """
+    block_size = 8192
+    end = fileobj.seek(0, io.SEEK_END)
+    if lines == 0:
+        return end
+    offset = end
+    newlines = 0
+    while offset > 0:
+        start = max(offset - block_size, 0)
+        fileobj.seek(start)
+        block = fileobj.read(offset - start)
+        # A trailing newline ends the last line rather than starting a new one
+        if offset == end and block.endswith(b"\n"):
+            block = block[:-1]
+        pos = len(block)
+        while True:
+            pos = block.rfind(b"\n", 0, pos)
+            if pos < 0:
+                break
+            newlines += 1
+            if newlines == lines:
+                return start + pos + 1
+        offset = start
+    return 0
+
+class FileWatcher:
+    """
+    Waits for files in a directory to change, using inotify when the C library
+    provides it and falling back to polling otherwise.
+    """
+
+    IN_MODIFY = 0x002
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_CLOEXEC = 0o2000000
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, dir_path):
+        self.fd = None
+        try:
+            import ctypes
+            libc = ctypes.CDLL(None, use_errno=True)
+            fd = libc.inotify_init1(self.IN_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+            mask = self.IN_MODIFY | self.IN_MOVED_TO | self.IN_CREATE
+            if libc.inotify_add_watch(fd, os.fsencode(dir_path), mask) < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+            self.fd = fd
+        except (ImportError, AttributeError, OSError) as err:
+            logging.debug("inotify unavailable, polling instead: %s", err)
+
+    def wait(self):
+        """Return once a file in the directory may have changed."""
+        import select
+        if self.fd is None:
+            time.sleep(self.POLL_INTERVAL)
+            return
+        select.select([self.fd], [], [])
+        # The events themselves are not needed, only that something changed
+        os.read(self.fd, 65536)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+class StateTable(collections.abc.MutableMapping):
+    """
+    Mapping from names to the JSON records held in one table of the state
+    database. Records are loaded individually when first accessed and changes
+    are held in memory until they are committed by PossumState.commit(), so the
+    cost of reading or updating one record does not depend on how many other
+    records exist.
+    """
+
+    def __init__(self, db, table):
+        self.db = db
+        self.table = table
+        self.loaded = {}
+        self.deleted = set()
+        self.names = None
+
+    def _load(self, name):
+        if name in self.loaded:
+            return self.loaded[name][1]
+        if name in self.deleted:
+            return None
+        row = self.db.execute("SELECT data FROM %s WHERE name = ?" % self.table,
+                              (name,)).fetchone()
+        if row is None:
+            return None
+        record = json.loads(row[0])
+        self.loaded[name] = (row[0], record)
+        return record
+
+    def _names(self):
+        if self.names is None:
+            self.names = [row[0] for row in self.db.execute(
+                "SELECT name FROM %s ORDER BY rowid" % self.table)]
+        return self.names
+
+    def __getitem__(self, name):
+        record = self._load(name)
+        if record is None:
+            raise KeyError(name)
+        return record
+
+    def __contains__(self, name):
+        return self._load(name) is not None
+
+    def __setitem__(self, name, record):
+        if self._load(name) is None:
+            self._names().append(name)
+        self.loaded[name] = (None, record)
+        self.deleted.discard(name)
+
+    def __delitem__(self, name):
+        if self._load(name) is None:
+            raise KeyError(name)
+        self._names().remove(name)
+        del self.loaded[name]
+        self.deleted.add(name)
+
+    def __iter__(self):
+        return iter(list(self._names()))
+
+    def __len__(self):
+        return len(self._names())
+
+    def commit(self):
+        for name in self.deleted:
+            self.db.execute("DELETE FROM %s WHERE name = ?" % self.table,
+                            (name,))
+        for (name, (original, record)) in self.loaded.items():
+            data = json.dumps(record, sort_keys=True)
+            if data == original:
+                continue
+            self.db.execute("INSERT INTO %s (name, data) VALUES (?, ?) "
+                            "ON CONFLICT (name) DO UPDATE SET data = excluded.data"
+                            % self.table, (name, data))
+            self.loaded[name] = (data, record)
+        self.deleted.clear()
+
+class PossumState:
+    """
+    Guest and source state held in an SQLite database with one record per
+    guest and per source. State is accessed like the dict it replaces, as
+    `state['guests'][name]`, and all changes are written in a single atomic
+    transaction by commit().
+    """
+
+    TABLES = ('sources', 'guests', 'images')
+
+    def __init__(self, db_path):
+        import sqlite3
+        self.db = sqlite3.connect(db_path, isolation_level=None,
+                                  check_same_thread=False)
+        with self.db:
+            self.db.execute("BEGIN")
+            for table in self.TABLES:
+                self.db.execute("CREATE TABLE IF NOT EXISTS %s (name TEXT "
+                                "PRIMARY KEY, data TEXT NOT NULL)" % table)
+        self.tables = {table: StateTable(self.db, table)
+                       for table in self.TABLES}
+        self.data_version = self._data_version()
+
+    def _data_version(self):
+        # Changes whenever another connection commits to the database
+        return self.db.execute("PRAGMA data_version").fetchone()[0]
+
+    def unchanged(self):
+        """
+        Return True if no other connection has modified the database since
+        this state was loaded.
+        """
+        return self._data_version() == self.data_version
+
+    def __getitem__(self, table):
+        return self.tables[table]
+
+    def __contains__(self, table):
+        return table in self.tables
+
+    def commit(self):
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            for table in self.tables.values():
+                table.commit()
+
+    def import_json(self, state):
+        """Add all records from a state dict in the old JSON format."""
+        for table in self.TABLES:
+            for (name, record) in state.get(table, {}).items():
+                self.tables[table][name] = record
+        self.commit()
+
+    def close(self):
+        self.db.close()
 
 class PossumSysmgr:
     def __init__(self):
         self.statefile = None
-
+        self.state_shared = False
+        # Set for commands run by the daemon alongside others, which then read
+        # the state without taking the state lock
+        self.unlocked_reads = False
+        self.snapshot = None
+        self.snapshot_key = None
+        self.transaction = None
+        # Side effects of commands in the current transaction which are undone
+        # or only carried out once it is committed
+        self.transaction_paths = []
+        self.transaction_removals = []
+        self.transaction_events = []
+        self._config = None
+        self.http = None
+        self.spec_template = None
+        self.cgroups = None
+        self.event_listeners = []
+
+    @property
+    def config(self):
+        # Loaded on first use as many commands never need it
+        if self._config is None:
+            self._config = load_config()
+        return self._config
+
+    @releases_state_on_error
     def add_source(self, name, url):
         state = self._lock_and_read_state()
-        if "sources" in state:
-            if name in state['sources']:
-                logging.error("Source %s already defined!", name)
-                return
-        else:
-            state['sources'] = {}
+        if name in state['sources']:
+            logging.error("Source %s already defined!", name)
+            self._unlock_and_discard_state()
+            return
 
         state['sources'][name] = {
             'url': url
@@ -123,262 +2216,1101 @@ class PossumSysmgr:
         self._unlock_and_write_state(state)
         logging.info("Added source \"%s\" with URL \"%s\"", name, url)
 
+    @releases_state_on_error
     def remove_source(self, name):
         state = self._lock_and_read_state()
-        if "sources" not in state:
-            logging.error("Source %s not defined!", name)
-            return
         if name not in state['sources']:
             logging.error("Source %s not defined!", name)
+            self._unlock_and_discard_state()
             return
 
         del state['sources'][name]
+        unpinned = []
+        for image in state['images']:
+            if state['images'][image]['source_name'] == name:
+                if state['images'][image]['storage'] != 'overlay':
+                    unpinned.append(state['images'][image]['rootfs_url'])
+                del state['images'][image]
         self._unlock_and_write_state(state)
+        if unpinned:
+            self._artifact_cache().unpin(unpinned)
         logging.info("Removed source \"%s\"", name)
 
     def list_sources(self):
-        state = self._lock_and_read_state()
+        state = self._lock_and_read_state(shared=True)
         self._unlock_and_discard_state()
-        if "sources" not in state:
-            return
 
         for name in state['sources']:
             print(name)
 
     def show_source(self, name):
-        state = self._lock_and_read_state()
+        state = self._lock_and_read_state(shared=True)
         self._unlock_and_discard_state()
-        if "sources" not in state:
-            logging.error("Source %s not defined!", name)
-            return
         if name not in state['sources']:
             logging.error("Source %s not defined!", name)
             return
 
         print(json.dumps(state['sources'][name], indent=4, sort_keys=True))
 
+    @releases_state_on_error
     def add_guest(self, name, image):
         state = self._lock_and_read_state()
-        if "guests" in state:
-            if name in state['guests']:
-                logging.error("Guest %s already defined!", name)
-                return
-        else:
-            state['guests'] = {}
+        if not self._check_new_guest_name(state, name):
+            self._unlock_and_discard_state()
+            return
 
-        # For now, image name must be fully qualified as "<source>:<image>". In
-        # the future we should support unqualified image names which we will
-        # search for in each configured source
-        (source_name, image_name) = image.split(":")
+        resolved = self._resolve_image(state, image)
+        if resolved is None:
+            self._unlock_and_discard_state()
+            return
 
-        if source_name not in state['sources']:
-            logging.error("Source %s not defined!", name)
+        storage = self._storage_mode()
+        try:
+            layer = self._fetch_image(
+                resolved['rootfs_url'], storage,
+                expected_digest=resolved['image_config'].get('ROOTFS_SHA256'))
+            state['guests'][name] = self._create_guest(name, resolved, storage,
+                                                       layer)
+        except ValueError as err:
+            logging.error("Failed to add guest \"%s\": %s", name, err)
+            self._unlock_and_discard_state()
             return
 
+        self._unlock_and_write_state(state)
+        logging.info("Added guest \"%s\" from image \"%s\"", name,
+                     resolved['image'])
+        self._emit_event('added', name)
+
+    @staticmethod
+    def _check_new_guest_name(state, name):
+        """
+        Return True if a new guest may be called `name`, or False after logging
+        an error. Guest directories share STATE_ROOT with possumcmd's own files
+        so those names are not allowed.
+        """
+        if name in state['guests']:
+            logging.error("Guest %s already defined!", name)
+            return False
+        if name in RESERVED_NAMES or name.startswith(".") or "/" in name:
+            logging.error("Invalid guest name \"%s\"!", name)
+            return False
+        if os.path.lexists(os.path.join(STATE_ROOT, name)):
+            logging.error("Guest %s is not defined but \"%s\" exists, remove it "
+                          "first!", name, os.path.join(STATE_ROOT, name))
+            return False
+        return True
+
+    @traced("resolve_image")
+    def _resolve_image(self, state, image, use_pulled=True):
+        """
+        Look up the configuration of `image` from its source, or from the state
+        if it has been pulled and `use_pulled` is set. Images may be given as
+        "<source>:<image>" or by name alone if exactly one source's catalog
+        lists them. Returns a dict describing the image, or None after logging
+        an error.
+        """
+        if ":" in image:
+            (source_name, image_name) = image.split(":", 1)
+        else:
+            image_name = image
+            source_name = self._find_image_source(state, image_name, use_pulled)
+            if source_name is None:
+                return None
+            image = "%s:%s" % (source_name, image_name)
+
+        if source_name not in state['sources']:
+            logging.error("Source %s not defined!", source_name)
+            return None
+
         source = state['sources'][source_name]
+        if use_pulled and image in state['images']:
+            logging.debug("Using pulled image \"%s\"", image)
+            pulled = state['images'][image]
+            return {
+                'image': image,
+                'image_name': image_name,
+                'image_config': pulled['image_config'],
+                'source_name': source_name,
+                'source': source,
+                'rootfs_url': pulled['rootfs_url'],
+            }
 
         image_root = os.path.join(source['url'], 'guest', image_name)
-        image_config = get_image_config(image_root)
+        try:
+            image_config = get_image_config(image_root,
+                                            self._metadata_cache())
+        except OSError as err:
+            logging.error("Failed to retrieve image \"%s\": %s", image, err)
+            return None
 
         if image_config['SYSTEM_PROFILE_TYPE'] != 'guest':
             logging.error("Image \"%s\" is not a valid guest image!", image)
-            return
-
-        rootfs_url = os.path.join(image_root, image_config['ROOTFS'])
-        local_path = os.path.join("/var/lib/possum-guests", name)
-        install_rootfs(rootfs_url, local_path)
-        create_spec_file(name, local_path, image_config['COMMAND'],
-                         image_config['CAPABILITIES'])
+            return None
 
-        state['guests'][name] = {
+        return {
+            'image': image,
             'image_name': image_name,
-            'image': image_config,
+            'image_config': image_config,
             'source_name': source_name,
             'source': source,
+            'rootfs_url': os.path.join(image_root, image_config['ROOTFS']),
+        }
+
+    def _find_image_source(self, state, image_name, use_pulled=True):
+        """
+        Return the name of the only source providing `image_name`, preferring
+        pulled images if `use_pulled` is set, or None after logging an error.
+        """
+        if use_pulled:
+            pulled = [image['source_name'] for image in state['images'].values()
+                      if image['image_name'] == image_name]
+            if len(pulled) == 1:
+                return pulled[0]
+
+        catalogs = self._fetch_catalogs(state['sources'])
+        matches = [name for name in catalogs if image_name in catalogs[name]]
+        if not matches:
+            logging.error("Image \"%s\" not found in any source!", image_name)
+            return None
+        if len(matches) > 1:
+            logging.error("Image \"%s\" is available from sources %s, use "
+                          "\"<source>:<image>\" to choose one!", image_name,
+                          ", ".join(matches))
+            return None
+        return matches[0]
+
+    @traced("fetch_catalogs")
+    def _fetch_catalogs(self, sources):
+        """
+        Fetch the catalog of each of `sources` in parallel. Returns a dict
+        mapping source names to their catalog's images, in the order of
+        `sources`. Sources without a catalog are left out.
+        """
+        import concurrent.futures
+        cache = self._catalog_cache()
+        urls = {name: os.path.join(sources[name]['url'], "index.json")
+                for name in sources}
+
+        def fetch(name):
+            images = json.loads(cache.fetch(urls[name]))['images']
+            if not isinstance(images, dict):
+                raise ValueError("invalid catalog")
+            return images
+
+        catalogs = {}
+        jobs = max(self.config.getint('fetch_jobs'), 1)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(fetch, name): name for name in urls}
+            for future in concurrent.futures.as_completed(futures):
+                name = futures[future]
+                try:
+                    catalogs[name] = future.result()
+                except (OSError, ValueError, KeyError, TypeError) as err:
+                    # Catalogs are optional so this is not an error
+                    logging.warning("No catalog available for source \"%s\": "
+                                    "%s", name, err)
+        return {name: catalogs[name] for name in urls if name in catalogs}
+
+    def list_images(self, source_name=None, term=None):
+        """
+        Print the images listed in the catalogs of all sources, or only
+        `source_name`, which have `term` in their name or description.
+        """
+        state = self._lock_and_read_state(shared=True)
+        self._unlock_and_discard_state()
+        sources = state['sources']
+        if source_name is not None:
+            if source_name not in sources:
+                logging.error("Source %s not defined!", source_name)
+                return
+            sources = {source_name: sources[source_name]}
+
+        catalogs = self._fetch_catalogs(sources)
+        for (name, images) in catalogs.items():
+            for image_name in sorted(images):
+                info = images[image_name]
+                text = image_name + " " + info.get('description', '')
+                if term is not None and term.lower() not in text.lower():
+                    continue
+                image = "%s:%s" % (name, image_name)
+                print(("%-32s %-12s %-12s %s" % (
+                    image, info.get('version', '-'),
+                    info.get('digest', '-')[:12],
+                    "pulled" if image in state['images'] else "")).rstrip())
+
+    @traced("fetch_image")
+    def _fetch_image(self, rootfs_url, storage, prefetch=False,
+                     expected_digest=None):
+        """
+        Make the rootfs at `rootfs_url` available locally. For overlay storage
+        the shared layer is installed and its digest returned. Otherwise each
+        guest extracts its own copy, so the archive is only downloaded into the
+        cache here if `prefetch` is set, for use by several guests. The archive
+        must match `expected_digest` if given.
+        """
+        if storage == 'overlay':
+            return self._layer_store().install(rootfs_url,
+                                               self._artifact_cache(),
+                                               self._downloader(),
+                                               expected_digest)
+        cache = self._artifact_cache()
+        if prefetch and cache.enabled:
+            cache.fetch(rootfs_url, self._downloader(), expected_digest)
+        return None
+
+    @releases_state_on_error
+    def pull(self, images):
+        """
+        Fetch `images` from their sources in parallel into the layer store or
+        artifact cache without creating any guests. Their configuration is
+        recorded in the state so that adding guests from them later does not
+        need to contact the source.
+        """
+        start_time = time.monotonic()
+        storage = self._storage_mode()
+        cache = self._artifact_cache()
+        if storage != 'overlay' and not cache.enabled:
+            logging.error("Images cannot be pulled while the cache is disabled!")
+            return
+
+        state = self._lock_and_read_state(shared=True)
+        self._unlock_and_discard_state()
+        resolved = {}
+        for image in images:
+            image_info = self._resolve_image(state, image, use_pulled=False)
+            if image_info is not None:
+                resolved[image] = image_info
+
+        def fetch(image):
+            rootfs_url = resolved[image]['rootfs_url']
+            expected_digest = resolved[image]['image_config'].get('ROOTFS_SHA256')
+            if storage == 'overlay':
+                return self._fetch_image(rootfs_url, storage,
+                                         expected_digest=expected_digest)
+            # Pinned so that the archive stays available while the image is
+            # recorded as pulled
+            return os.path.basename(cache.fetch(rootfs_url, self._downloader(),
+                                                expected_digest, pin=True))
+        digests = self._map_parallel(fetch, resolved, "pull image")
+
+        state = self._lock_and_read_state()
+        for image in resolved:
+            if image not in digests:
+                continue
+            image_info = resolved[image]
+            if image_info['source_name'] not in state['sources']:
+                logging.error("Source %s removed while pulling \"%s\"!",
+                              image_info['source_name'], image)
+                del digests[image]
+                if storage != 'overlay':
+                    cache.unpin([image_info['rootfs_url']])
+                continue
+            state['images'][image_info['image']] = {
+                'image_name': image_info['image_name'],
+                'image_config': image_info['image_config'],
+                'source_name': image_info['source_name'],
+                'rootfs_url': image_info['rootfs_url'],
+                'storage': storage,
+                'digest': digests[image],
+                'pulled': time.time(),
+            }
+            logging.info("Pulled image \"%s\"", image_info['image'])
+        self._unlock_and_write_state(state)
+        logging.info("Pulled %d of %d images in %.2fs", len(digests),
+                     len(images), time.monotonic() - start_time)
+
+    @traced("create_guest")
+    def _create_guest(self, name, resolved, storage, layer):
+        """
+        Create the directory and spec file of a new guest from an image
+        resolved by _resolve_image() and fetched by _fetch_image(). Returns the
+        guest's state record. The directory is removed again on failure.
+        """
+        import shutil
+        image_config = resolved['image_config']
+        local_path = os.path.join(STATE_ROOT, name)
+        guest = {
+            'image_name': resolved['image_name'],
+            'image': image_config,
+            'source_name': resolved['source_name'],
+            'source': resolved['source'],
             'path': local_path,
             'autostart_enabled': 0,
+            'storage': storage,
+            'created': time.time(),
         }
+        self._created_path(local_path)
+        try:
+            if storage == 'overlay':
+                guest['layer'] = layer
+                for dname in ("rootfs", "upper", "work"):
+                    os.makedirs(os.path.join(local_path, dname))
+            else:
+                rootfs_path = os.path.join(local_path, "rootfs")
+                install_rootfs(resolved['rootfs_url'], rootfs_path,
+                               self._artifact_cache(), self._downloader(),
+                               image_config.get('ROOTFS_SHA256'))
+                # Lets verify check the guest's files, and upgrade_guest skip
+                # hashing files which have not been modified since
+                write_json_file(os.path.join(local_path, "manifest.json"),
+                                tree_manifest(rootfs_path))
+            create_spec_file(name, local_path, image_config['COMMAND'],
+                             image_config['CAPABILITIES'],
+                             self._spec_template())
+        except BaseException:
+            # A partly extracted guest would block adding it again
+            shutil.rmtree(local_path, ignore_errors=True)
+            raise
+        return guest
+
+    @releases_state_on_error
+    def clone_guest(self, src, dst, hardlink=False):
+        import copy
+        import shutil
+        state = self._lock_and_read_state()
+        if src not in state['guests']:
+            logging.error("Guest %s not defined!", src)
+            self._unlock_and_discard_state()
+            return
+        if not self._check_new_guest_name(state, dst):
+            self._unlock_and_discard_state()
+            return
 
-        self._unlock_and_write_state(state)
-        logging.info("Added guest \"%s\" from image \"%s\"", name, image)
+        containers = self._runc_list()
+        if src in containers and containers[src]['status'] != 'stopped':
+            logging.error("Guest %s is running, stop it before cloning!", src)
+            self._unlock_and_discard_state()
+            return
 
-    def remove_guest(self, name):
+        guest = copy.deepcopy(state['guests'][src])
+        src_path = guest['path']
+        local_path = os.path.join(STATE_ROOT, dst)
+        # Files with timestamps from before the source guest was created have
+        # not been modified since they were extracted from the image. Guests
+        # write to their rootfs in place, so sharing these files is opt-in
+        unchanged_before = None
+        if hardlink:
+            unchanged_before = guest.get('created')
+            if unchanged_before is None:
+                unchanged_before = os.path.getmtime(os.path.join(src_path,
+                                                                 "config.json"))
+
+        self._created_path(local_path)
+        os.makedirs(local_path)
+        if guest.get('storage') == 'overlay':
+            # Only the guest's own changes need copying, never hardlinking
+            counts = clone_tree(os.path.join(src_path, "upper"),
+                                os.path.join(local_path, "upper"))
+            for dname in ("rootfs", "work"):
+                os.makedirs(os.path.join(local_path, dname))
+        else:
+            counts = clone_tree(os.path.join(src_path, "rootfs"),
+                                os.path.join(local_path, "rootfs"),
+                                unchanged_before)
+        manifest_path = os.path.join(src_path, "manifest.json")
+        if os.path.exists(manifest_path):
+            # Keeps its timestamp, which upgrade_guest compares with those of
+            # the cloned files
+            shutil.copy2(manifest_path, os.path.join(local_path,
+                                                     "manifest.json"))
+        create_spec_file(dst, local_path, guest['image']['COMMAND'],
+                         guest['image']['CAPABILITIES'], self._spec_template())
+
+        guest['path'] = local_path
+        guest['autostart_enabled'] = 0
+        guest['created'] = time.time()
+        guest['cloned_from'] = src
+        state['guests'][dst] = guest
+
+        self._unlock_and_write_state(state)
+        logging.info("Cloned guest \"%s\" to \"%s\" (%d files reflinked, "
+                     "%d hardlinked, %d copied)", src, dst, counts['reflinked'],
+                     counts['hardlinked'], counts['copied'])
+        if counts['hardlinked']:
+            logging.warning("Hardlinked files are shared with guest \"%s\", "
+                            "writing to them in place changes both guests", src)
+        self._emit_event('added', dst)
+
+    @releases_state_on_error
+    def upgrade_guest(self, name, image=None):
+        """
+        Upgrade the stopped guest `name` to the latest version of `image`, or of
+        the image it was created from, using the per-file manifest published
+        with the image so that only changed files are downloaded.
+        """
+        import shutil
+        import tempfile
+        start_time = time.monotonic()
         state = self._lock_and_read_state()
-        if "guests" not in state:
+        if name not in state['guests']:
             logging.error("Guest %s not defined!", name)
+            self._unlock_and_discard_state()
+            return
+        guest = state['guests'][name]
+
+        containers = self._runc_list()
+        if name in containers and containers[name]['status'] != 'stopped':
+            logging.error("Guest %s is running, stop it before upgrading!", name)
+            self._unlock_and_discard_state()
+            return
+
+        if image is None:
+            image = "%s:%s" % (guest['source_name'], guest['image_name'])
+        resolved = self._resolve_image(state, image, use_pulled=False)
+        if resolved is None:
+            self._unlock_and_discard_state()
+            return
+        image_config = resolved['image_config']
+        if 'MANIFEST' not in image_config:
+            logging.error("Image \"%s\" has no manifest, remove and re-add the "
+                          "guest to change its image!", image)
+            self._unlock_and_discard_state()
+            return
+
+        image_root = os.path.dirname(resolved['rootfs_url'])
+        manifest_url = os.path.join(image_root, image_config['MANIFEST'])
+        downloader = self._downloader()
+        try:
+            manifest_data = io.BytesIO()
+            manifest_digest = downloader.download(manifest_url, manifest_data)
+            manifest = json.loads(manifest_data.getvalue())
+        except (OSError, ValueError) as err:
+            logging.error("Failed to retrieve manifest for \"%s\": %s", image,
+                          err)
+            self._unlock_and_discard_state()
             return
+
+        local_path = guest['path']
+        writable = [path.strip("/")
+                    for path in image_config.get('WRITABLE_PATHS', [])]
+        manifest_path = os.path.join(local_path, "manifest.json")
+        previous_path = manifest_path
+        if guest.get('storage') == 'overlay' and \
+                not os.path.exists(manifest_path):
+            previous_path = self._layer_store().manifest_path(guest['layer'])
+        previous = None
+        previous_time = 0
+        if os.path.exists(previous_path):
+            with open(previous_path) as f:
+                previous = json.load(f)
+            # Files in a layer are never modified after it is built
+            previous_time = float('inf') if guest.get('storage') == 'overlay' \
+                else os.path.getmtime(manifest_path)
+
+        if guest.get('storage') == 'overlay':
+            # Build a new layer from the old one, leaving the old one untouched
+            # for other guests. The guest's own changes are in its upper dir
+            layers = self._layer_store()
+            base_path = layers.layer_path(guest['layer'])
+            staging_path = tempfile.mkdtemp(dir=layers.layers_path, prefix="tmp")
+            if os.path.isdir(layers.layer_path(manifest_digest)):
+                base_path = None
+            tree_writable = []
+        else:
+            recover_rootfs(local_path)
+            base_path = os.path.join(local_path, "rootfs")
+            staging_path = tempfile.mkdtemp(dir=local_path, prefix="tmp")
+            tree_writable = writable
+        staging_rootfs = os.path.join(staging_path, "rootfs")
+        objects_path = os.path.join(staging_path, "objects")
+
+        missing = {}
+        try:
+            if base_path is not None:
+                clone_tree(base_path, staging_rootfs, time.time())
+                missing = manifest_missing_objects(manifest, staging_rootfs,
+                                                   tree_writable, previous,
+                                                   previous_time)
+                os.mkdir(objects_path)
+
+                def fetch(digest):
+                    object_url = os.path.join(image_root, "objects",
+                                              digest[:2], digest)
+                    object_path = os.path.join(objects_path, digest)
+                    with open(object_path, 'wb') as object_file:
+                        if downloader.download(object_url,
+                                               object_file) != digest:
+                            raise ValueError("digest mismatch")
+                fetched = self._map_parallel(fetch, missing, "fetch object")
+                if len(fetched) < len(missing):
+                    shutil.rmtree(staging_path)
+                    self._unlock_and_discard_state()
+                    return
+                apply_manifest(manifest, staging_rootfs, objects_path,
+                               tree_writable)
+
+            if guest.get('storage') == 'overlay':
+                self._unmount_rootfs(local_path)
+                if base_path is not None:
+                    write_json_file(layers.manifest_path(manifest_digest),
+                                    manifest)
+                    os.rename(staging_rootfs,
+                              layers.layer_path(manifest_digest))
+                layers.register(manifest_url, manifest_digest)
+                guest['layer'] = manifest_digest
+                shutil.rmtree(staging_path)
+                # Changes outside the writable paths would hide the new files
+                reset_upper_dir(os.path.join(local_path, "upper"), writable)
+            else:
+                if not exchange_paths(staging_rootfs, base_path):
+                    # The guest has no rootfs between these two renames, which
+                    # recover_rootfs() repairs after a crash
+                    os.rename(base_path, os.path.join(staging_path, "old"))
+                    os.rename(staging_rootfs, base_path)
+                shutil.rmtree(staging_path)
+        except BaseException:
+            if guest.get('storage') != 'overlay':
+                recover_rootfs(local_path)
+            shutil.rmtree(staging_path, ignore_errors=True)
+            self._unlock_and_discard_state()
+            raise
+
+        write_json_file(manifest_path, manifest)
+        guest['image_name'] = resolved['image_name']
+        guest['image'] = image_config
+        guest['source_name'] = resolved['source_name']
+        guest['source'] = resolved['source']
+        guest['upgraded'] = time.time()
+        create_spec_file(name, local_path, image_config['COMMAND'],
+                         image_config['CAPABILITIES'], self._spec_template())
+        self._unlock_and_write_state(state)
+        logging.info("Upgraded guest \"%s\" to image \"%s\" in %.2fs (%d files, "
+                     "%s fetched)", name, image, time.monotonic() - start_time,
+                     len(missing), format_size(sum(missing.values())))
+        self._emit_event('upgraded', name)
+
+    @releases_state_on_error
+    def remove_guest(self, name):
+        state = self._lock_and_read_state()
         if name not in state['guests']:
             logging.error("Guest %s not defined!", name)
+            self._unlock_and_discard_state()
             return
 
-        guest_path = state['guests'][name]['path']
-        logging.debug("Deleting data from \"%s\"...", guest_path)
-        shutil.rmtree(guest_path)
+        self._remove_path(state['guests'][name]['path'])
         del state['guests'][name]
         self._unlock_and_write_state(state)
         logging.info("Removed guest \"%s\"", name)
+        self._emit_event('removed', name)
 
     def list_guests(self):
-        state = self._lock_and_read_state()
+        state = self._lock_and_read_state(shared=True)
         self._unlock_and_discard_state()
-        if "guests" not in state:
-            return
 
         for name in state['guests']:
             print(name)
 
-    def show_guest(self, name):
-        state = self._lock_and_read_state()
+    def guest_status(self, json_output=False):
+        import subprocess
+        state = self._lock_and_read_state(shared=True)
         self._unlock_and_discard_state()
-        if "guests" not in state:
-            logging.error("Guest %s not defined!", name)
+        try:
+            containers = self._runc_list()
+        except (OSError, subprocess.CalledProcessError) as err:
+            logging.error("Failed to list guests: %s", err)
             return
+
+        rows = []
+        for name in state['guests']:
+            container = containers.get(name, {})
+            rows.append({
+                'name': name,
+                'status': container.get('status', 'none'),
+                # runc reports a PID of 0 for stopped containers
+                'pid': container.get('pid') or None,
+                'created': container.get('created'),
+                'autostart': state['guests'][name]['autostart_enabled'] == 1,
+            })
+
+        if json_output:
+            print(json.dumps(rows, indent=4))
+            return
+        width = max([len(row['name']) for row in rows] + [len("NAME")])
+        print("%-*s  %-8s  %7s  %-19s  %s" % (width, "NAME", "STATUS", "PID",
+                                             "CREATED", "AUTOSTART"))
+        for row in rows:
+            # Trim RFC 3339 timestamps from runc to whole seconds
+            created = (row['created'] or "-")[:19]
+            print("%-*s  %-8s  %7s  %-19s  %s" % (
+                width, row['name'], row['status'], row['pid'] or "-", created,
+                "yes" if row['autostart'] else "no"))
+
+    def metrics(self, output_path=None, interval=None):
+        """
+        Print resource usage metrics for all guests in Prometheus text format,
+        or write them atomically to `output_path`. If `interval` is given, the
+        metrics are written again every `interval` seconds until interrupted.
+        """
+        next_time = time.monotonic()
+        while True:
+            text = self._collect_metrics()
+            if text is None:
+                return
+            if output_path is None:
+                sys.stdout.write(text)
+                sys.stdout.flush()
+            else:
+                write_text_file(output_path, text)
+            if interval is None:
+                return
+            next_time += interval
+            time.sleep(max(next_time - time.monotonic(), 0))
+
+    def _collect_metrics(self):
+        import subprocess
+        state = self._lock_and_read_state(shared=True)
+        self._unlock_and_discard_state()
+        try:
+            containers = self._runc_list()
+        except (OSError, subprocess.CalledProcessError) as err:
+            logging.error("Failed to list guests: %s", err)
+            return None
+
+        if self.cgroups is None:
+            self.cgroups = CgroupReader()
+        running = {}
+        for name in state['guests']:
+            container = containers.get(name)
+            if container and container['status'] == 'running' and \
+                    container.get('pid'):
+                running[name] = container['pid']
+        self.cgroups.forget(set(running.values()))
+
+        stats = {}
+        for (name, pid) in running.items():
+            try:
+                stats[name] = self.cgroups.read(pid)
+            except OSError as err:
+                # The guest may have exited since it was listed
+                logging.debug("Cannot read cgroup of guest \"%s\": %s", name,
+                              err)
+                self.cgroups.close(pid)
+
+        lines = [
+            "# HELP possum_guest_running Whether the guest is running",
+            "# TYPE possum_guest_running gauge",
+        ]
+        for name in state['guests']:
+            lines.append('possum_guest_running{guest="%s"} %d'
+                         % (prometheus_escape(name), name in running))
+        for (key, metric, metric_type, help_text) in GUEST_METRICS:
+            lines.append("# HELP %s %s" % (metric, help_text))
+            lines.append("# TYPE %s %s" % (metric, metric_type))
+            for name in stats:
+                if key in stats[name]:
+                    lines.append('%s{guest="%s"} %s' % (
+                        metric, prometheus_escape(name), stats[name][key]))
+        return "\n".join(lines) + "\n"
+
+    def show_guest(self, name):
+        state = self._lock_and_read_state(shared=True)
+        self._unlock_and_discard_state()
         if name not in state['guests']:
             logging.error("Guest %s not defined!", name)
             return
 
         print(json.dumps(state['guests'][name], indent=4, sort_keys=True))
 
+    @releases_state_on_error
     def enable_guest(self, name):
         state = self._lock_and_read_state()
-        if "guests" not in state:
-            logging.error("Guest %s not defined!", name)
-            return
         if name not in state['guests']:
             logging.error("Guest %s not defined!", name)
+            self._unlock_and_discard_state()
             return
         if state['guests'][name]['autostart_enabled'] == 1:
             logging.error("Guest %s already enabled!", name)
+            self._unlock_and_discard_state()
             return
 
         state['guests'][name]['autostart_enabled'] = 1
 
         self._unlock_and_write_state(state)
         logging.info("Enabled guest \"%s\"", name)
+        self._emit_event('enabled', name)
 
+    @releases_state_on_error
     def disable_guest(self, name):
         state = self._lock_and_read_state()
-        if "guests" not in state:
-            logging.error("Guest %s not defined!", name)
-            return
         if name not in state['guests']:
             logging.error("Guest %s not defined!", name)
+            self._unlock_and_discard_state()
             return
         if state['guests'][name]['autostart_enabled'] == 0:
             logging.error("Guest %s already disabled!", name)
+            self._unlock_and_discard_state()
             return
 
         state['guests'][name]['autostart_enabled'] = 0
 
         self._unlock_and_write_state(state)
         logging.info("Disabled guest \"%s\"", name)
+        self._emit_event('disabled', name)
+
+    @releases_state_on_error
+    def set_guest_deps(self, name, kind, deps):
+        state = self._lock_and_read_state()
+        if name not in state['guests']:
+            logging.error("Guest %s not defined!", name)
+            self._unlock_and_discard_state()
+            return
+        if not self._check_guest_deps(state, name, deps):
+            self._unlock_and_discard_state()
+            return
+
+        state['guests'][name][kind] = deps
+
+        self._unlock_and_write_state(state)
+        logging.info("Set %s for guest \"%s\" to: %s", kind, name,
+                     " ".join(deps))
+
+    def _check_guest_deps(self, state, name, deps):
+        for dep in deps:
+            if dep not in state['guests']:
+                logging.error("Guest %s not defined!", dep)
+                return False
+            if dep == name:
+                logging.error("Guest %s cannot depend on itself!", name)
+                return False
+        return True
 
     def start_guest(self, name):
+        state = self._lock_and_read_state(shared=True)
+        self._unlock_and_discard_state()
+        if name not in state['guests']:
+            logging.error("Guest %s not defined!", name)
+            return
+
+        self._start_guest(name, state['guests'][name])
+
+    @traced("run_guest")
+    def _start_guest(self, name, guest):
+        import subprocess
+        from datetime import datetime
         runc_args = ["run", "-d", name]
-        log_path = os.path.join("/var/lib/possum-guests", name, "log")
+        log_path = os.path.join(STATE_ROOT, name, "log")
 
+        start_time = time.monotonic()
+        if guest.get('storage') == 'overlay':
+            self._mount_rootfs(guest)
+        else:
+            recover_rootfs(guest['path'])
+        rotate_log(log_path, self.config.getint('log_size') << 10,
+                   self.config.getint('log_count'))
         with open(log_path, "a") as logfile:
             timestamp = datetime.now().isoformat()
             logfile.write(">>> Starting guest \"%s\" at %s\n" % (name, timestamp))
             logfile.flush()
-            self.runc(name, runc_args, stdin=subprocess.DEVNULL, stdout=logfile,
-                      stderr=subprocess.STDOUT)
+            self._runc(name, runc_args, stdin=subprocess.DEVNULL, stdout=logfile,
+                       stderr=subprocess.STDOUT)
 
-        logging.info("Started guest \"%s\"", name)
+        logging.info("Started guest \"%s\" in %.2fs", name,
+                     time.monotonic() - start_time)
+        self._emit_event('started', name)
 
-    def stop_guest(self, name):
-        # TODO: Make timeout selectable and poll guest state to see if it has
-        # terminated early (https://gitlab.com/possum/possum/issues/41)
-        timeout = 10
-        runc_args = ["kill", name, "TERM"]
+    def rotate_logs(self, names=None):
+        """
+        Rotate the logs of the given guests, or of all guests, which have grown
+        beyond the 'log_size' setting.
+        """
+        state = self._lock_and_read_state(shared=True)
+        self._unlock_and_discard_state()
+        if names is None:
+            names = list(state['guests'])
+        for name in names:
+            if name not in state['guests']:
+                logging.error("Guest %s not defined!", name)
+                return
+
+        for name in names:
+            logging.debug("Checking log of guest \"%s\"...", name)
+            rotate_log(os.path.join(STATE_ROOT, name, "log"),
+                       self.config.getint('log_size') << 10,
+                       self.config.getint('log_count'))
+
+    def guest_logs(self, name, lines=None, follow=False):
+        """
+        Print the current log file of guest `name`, or only its last `lines`
+        lines. If `follow` is set, keep printing output as it is appended,
+        across log rotations, until interrupted.
+        """
+        state = self._lock_and_read_state(shared=True)
+        self._unlock_and_discard_state()
+        if name not in state['guests']:
+            logging.error("Guest %s not defined!", name)
+            return
+
+        log_path = os.path.join(STATE_ROOT, name, "log")
+        watcher = FileWatcher(os.path.dirname(log_path)) if follow else None
+        logfile = None
         try:
-            self.runc(name, runc_args)
-            logging.info("Sent SIGTERM, waiting for %d seconds", timeout)
-            time.sleep(timeout)
-        except subprocess.CalledProcessError as err:
-            logging.info("Failed to send SIGTERM: %s", err)
-            logging.info("Deleting guest immediately")
+            try:
+                logfile = open(log_path, "rb")
+            except FileNotFoundError:
+                if not follow:
+                    return
+            if logfile is not None and lines is not None:
+                logfile.seek(tail_offset(logfile, lines))
+            while True:
+                if logfile is not None:
+                    for data in iter(functools.partial(logfile.read, 65536), b""):
+                        sys.stdout.write(data.decode('utf-8', 'replace'))
+                    sys.stdout.flush()
+                if not follow:
+                    return
+                # Start again from the beginning once the log has been
+                # truncated by rotate_log()
+                if logfile is not None and \
+                        os.fstat(logfile.fileno()).st_size < logfile.tell():
+                    logfile.seek(0)
+                    continue
+                # Switch to the new file if the log has been replaced, after
+                # the rest of the old one has been printed above
+                try:
+                    st = os.stat(log_path)
+                    if logfile is None or \
+                            st.st_ino != os.fstat(logfile.fileno()).st_ino:
+                        if logfile is not None:
+                            logfile.close()
+                        logfile = open(log_path, "rb")
+                        continue
+                except FileNotFoundError:
+                    pass
+                watcher.wait()
+        finally:
+            if logfile is not None:
+                logfile.close()
+            if watcher is not None:
+                watcher.close()
+
+    def stop_guest(self, name, timeout=None):
+        state = self._lock_and_read_state(shared=True)
+        self._unlock_and_discard_state()
+        if name not in state['guests']:
+            logging.error("Guest %s not defined!", name)
+            return
 
-        runc_args = ["delete", "-f", name]
-        self.runc(name, runc_args)
-        logging.info("Stopped guest \"%s\"", name)
+        if name not in self._stop_guests([name], timeout):
+            logging.info("Guest \"%s\" is not running", name)
 
+    @traced("stop_guests")
+    def _stop_guests(self, names, timeout=None):
+        """
+        Stop the given guests together. SIGTERM is sent to every running guest,
+        then guest state is polled until all have exited or the shared timeout
+        expires. Guests which are still alive after the timeout are forcibly
+        deleted. Returns a dict mapping each guest which was found in runc to
+        True if it was stopped and deleted or False on failure.
+        """
+        import subprocess
+        if timeout is None:
+            timeout = self.config.getfloat('stop_timeout')
+
+        containers = self._runc_list()
+        names = [name for name in names if name in containers]
+        alive = []
+        for name in names:
+            if containers[name]['status'] == 'stopped':
+                continue
+            try:
+                self._runc(name, ["kill", name, "TERM"])
+                alive.append(name)
+            except subprocess.CalledProcessError as err:
+                logging.info("Failed to send SIGTERM to \"%s\": %s", name, err)
+
+        if alive:
+            logging.info("Sent SIGTERM to %d guests, waiting up to %g seconds",
+                         len(alive), timeout)
+        deadline = time.monotonic() + timeout
+        interval = 0.05
+        while alive and time.monotonic() < deadline:
+            time.sleep(min(interval, max(deadline - time.monotonic(), 0)))
+            interval = min(interval * 2, 1.0)
+            containers = self._runc_list()
+            alive = [name for name in alive if name in containers and
+                     containers[name]['status'] != 'stopped']
+
+        for name in alive:
+            logging.info("Guest \"%s\" did not exit in time, deleting it", name)
+        results = {}
+        for name in names:
+            try:
+                self._runc(name, ["delete", "-f", name])
+                self._unmount_rootfs(os.path.join(STATE_ROOT, name))
+                logging.info("Stopped guest \"%s\"", name)
+                self._emit_event('stopped', name)
+                results[name] = True
+            except subprocess.CalledProcessError as err:
+                logging.error("Failed to stop guest \"%s\": %s", name, err)
+                results[name] = False
+
+        return results
+
+    @releases_state_on_error
     def preconfigure(self):
-        if os.path.exists('/var/lib/possum-guests/preconfigure-done'):
+        import configparser
+        if os.path.exists(os.path.join(STATE_ROOT, "preconfigure-done")):
             logging.debug("Preconfiguration already done")
             return
 
-        if not os.path.exists('/usr/share/possum/preconfig.d'):
+        if not os.path.exists(PRECONFIG_PATH):
             logging.debug("No preconfiguration data")
             return
 
         logging.debug("Preconfiguration needed")
-        os.makedirs("/var/lib/possum-guests", exist_ok=True)
-        open('/var/lib/possum-guests/preconfigure-done', 'w').close()
+        os.makedirs(STATE_ROOT, exist_ok=True)
+        open(os.path.join(STATE_ROOT, "preconfigure-done"), 'w').close()
 
         logging.debug("Loading preconfiguration data...")
         preconfig = configparser.ConfigParser()
-        conf_list = os.listdir('/usr/share/possum/preconfig.d')
+        conf_list = os.listdir(PRECONFIG_PATH)
         conf_list.sort()
         for fname in conf_list:
-            path = os.path.join('/usr/share/possum/preconfig.d', fname)
+            path = os.path.join(PRECONFIG_PATH, fname)
             preconfig.read(path)
 
-        logging.debug("Setting up sources...")
-        for section in preconfig.sections():
-            if section.startswith('source:'):
-                name = section.split(':', 1)[1]
-                url = preconfig.get(section, 'url')
-                self.add_source(name, url)
+        start_time = time.monotonic()
+        state = self._lock_and_read_state()
 
-        logging.debug("Setting up guests...")
+        phase_time = time.monotonic()
+        sources = [section for section in preconfig.sections()
+                   if section.startswith('source:')]
+        for section in sources:
+            name = section.split(':', 1)[1]
+            if name in state['sources']:
+                logging.error("Source %s already defined!", name)
+                continue
+            url = preconfig.get(section, 'url')
+            state['sources'][name] = {
+                'url': url
+            }
+            logging.info("Added source \"%s\" with URL \"%s\"", name, url)
+        logging.info("Set up %d sources in %.2fs", len(sources),
+                     time.monotonic() - phase_time)
+
+        phase_time = time.monotonic()
+        guests = {}
         for section in preconfig.sections():
             if section.startswith('guest:'):
                 name = section.split(':', 1)[1]
-                image = preconfig.get(section, 'image')
-                enable = preconfig.get(section, 'enable')
-                self.add_guest(name, image)
-                if enable.lower() in ['true', 'yes', '1']:
-                    self.enable_guest(name)
+                if not self._check_new_guest_name(state, name):
+                    continue
+                resolved = self._resolve_image(state,
+                                               preconfig.get(section, 'image'))
+                if resolved is not None:
+                    guests[name] = (section, resolved)
+        images = collections.Counter(resolved['rootfs_url']
+                                     for (_, resolved) in guests.values())
+        expected_digests = {
+            resolved['rootfs_url']: resolved['image_config'].get('ROOTFS_SHA256')
+            for (_, resolved) in guests.values()}
+        logging.info("Resolved %d guests using %d images in %.2fs", len(guests),
+                     len(images), time.monotonic() - phase_time)
+
+        phase_time = time.monotonic()
+        storage = self._storage_mode()
+        layers = self._map_parallel(
+            lambda url: self._fetch_image(url, storage, images[url] > 1,
+                                          expected_digests[url]),
+            images, "fetch image")
+        logging.info("Fetched %d of %d images in %.2fs", len(layers),
+                     len(images), time.monotonic() - phase_time)
+
+        phase_time = time.monotonic()
+        guests = {name: guests[name] for name in guests
+                  if guests[name][1]['rootfs_url'] in layers}
+        def create(name):
+            resolved = guests[name][1]
+            return self._create_guest(name, resolved, storage,
+                                      layers[resolved['rootfs_url']])
+        records = self._map_parallel(create, guests, "create guest")
+        # Add the guests in the order they were configured, not created
+        records = {name: records[name] for name in guests if name in records}
+        for (name, guest) in records.items():
+            (section, resolved) = guests[name]
+            enable = preconfig.get(section, 'enable')
+            if enable.lower() in ['true', 'yes', '1']:
+                guest['autostart_enabled'] = 1
+            for kind in ('after', 'requires'):
+                if preconfig.has_option(section, kind):
+                    deps = parse_guest_list(preconfig.get(section, kind))
+                    guest[kind] = deps
+            state['guests'][name] = guest
+            logging.info("Added guest \"%s\" from image \"%s\"", name,
+                         resolved['image'])
+        for name in records:
+            for kind in ('after', 'requires'):
+                deps = state['guests'][name].get(kind, [])
+                if not self._check_guest_deps(state, name, deps):
+                    del state['guests'][name][kind]
+        logging.info("Created %d of %d guests in %.2fs", len(records),
+                     len(guests), time.monotonic() - phase_time)
 
-    def autostart_all(self):
-        state = self._lock_and_read_state()
-        self._unlock_and_discard_state()
-        if "guests" not in state:
-            state['guests'] = {}
+        self._unlock_and_write_state(state)
+        for name in records:
+            self._emit_event('added', name)
+        logging.info("Preconfiguration finished in %.2fs",
+                     time.monotonic() - start_time)
 
-        count = 0
-        count_success = 0
-        for name in state['guests']:
-            if state['guests'][name]['autostart_enabled'] == 1:
-                count += 1
+    def _map_parallel(self, func, keys, description):
+        """
+        Call `func` for each of `keys` using up to 'fetch_jobs' threads. Returns
+        a dict mapping each key for which `func` succeeded to its result.
+        """
+        import concurrent.futures
+        jobs = max(self.config.getint('fetch_jobs'), 1)
+        results = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(func, key): key for key in keys}
+            for future in concurrent.futures.as_completed(futures):
+                key = futures[future]
                 try:
-                    self.start_guest(name)
-                    count_success += 1
-                except subprocess.CalledProcessError as err:
-                    logging.error("Failed to start guest \"%s\": %s", name, err)
-
-        logging.info("Started %d of %d enabled guests", count_success, count)
-
-    def autostop_all(self):
-        state = self._lock_and_read_state()
+                    results[key] = future.result()
+                except Exception as err: # pylint: disable=broad-except
+                    logging.debug("Exception details:", exc_info=True)
+                    logging.error("Failed to %s \"%s\": %s", description, key,
+                                  err)
+        return results
+
+    def autostart_all(self, jobs=None):
+        import subprocess
+        state = self._lock_and_read_state(shared=True)
         self._unlock_and_discard_state()
-        if "guests" not in state:
-            state['guests'] = {}
+        if jobs is None:
+            jobs = self.config.getint('start_jobs')
 
-        count = 0
-        count_success = 0
-        for name in state['guests']:
-            count += 1
-            # TODO: Check if guest is actually running before we try to stop it
-            # (https://gitlab.com/possum/possum/issues/42)
+        def start(name):
             try:
-                self.stop_guest(name)
-                count_success += 1
-            except subprocess.CalledProcessError as err:
-                logging.info("Failed to stop guest \"%s\": %s", name, err)
+                self._start_guest(name, state['guests'][name])
+                return True
+            except (OSError, subprocess.CalledProcessError) as err:
+                logging.error("Failed to start guest \"%s\": %s", name, err)
+                return False
+
+        start_time = time.monotonic()
+        names = [name for name in state['guests']
+                 if state['guests'][name]['autostart_enabled'] == 1]
+        results = run_scheduled(names, state['guests'], start, max(jobs, 1))
+        count_success = sum(1 for success in results.values() if success)
+
+        logging.info("Started %d of %d enabled guests in %.2fs", count_success,
+                     len(names), time.monotonic() - start_time)
+
+    def autostop_all(self, timeout=None):
+        import subprocess
+        state = self._lock_and_read_state(shared=True)
+        self._unlock_and_discard_state()
 
-        logging.info("Stopped %d of %d guests", count_success, count)
+        start_time = time.monotonic()
+        try:
+            results = self._stop_guests(list(state['guests']), timeout)
+        except subprocess.CalledProcessError as err:
+            logging.error("Failed to list guests: %s", err)
+            return
+        count_success = sum(1 for success in results.values() if success)
+
+        logging.info("Stopped %d of %d running guests in %.2fs", count_success,
+                     len(results), time.monotonic() - start_time)
 
     def startup(self):
         self.preconfigure()
@@ -388,47 +3320,601 @@ class PossumSysmgr:
         self.autostop_all()
 
     def runc(self, name, runc_args, **kwargs):
-        state = self._lock_and_read_state()
+        state = self._lock_and_read_state(shared=True)
         self._unlock_and_discard_state()
-        if "guests" not in state:
-            logging.error("Guest %s not defined!", name)
-            return
         if name not in state['guests']:
             logging.error("Guest %s not defined!", name)
             return
 
-        local_path = os.path.join("/var/lib/possum-guests", name)
+        self._runc(name, runc_args, **kwargs)
+
+    def _runc(self, name, runc_args, **kwargs):
+        import subprocess
+        local_path = os.path.join(STATE_ROOT, name)
         args = ["runc"] + runc_args
-        subprocess.run(args, cwd=local_path, check=True, **kwargs)
+        with TRACER.span("runc " + runc_args[0], guest=name):
+            subprocess.run(args, cwd=local_path, check=True, **kwargs)
+
+    def cache_list(self):
+        from datetime import datetime
+        index = self._artifact_cache().list()
+        for url in sorted(index, key=lambda url: index[url]['last_used']):
+            entry = index[url]
+            last_used = datetime.fromtimestamp(entry['last_used'])
+            print("%s  %10s  %s  %s" % (entry['digest'][:12],
+                                        format_size(entry['size']),
+                                        last_used.isoformat(timespec='seconds'),
+                                        url))
+
+    def verify(self):
+        """
+        Check the SHA-256 digests of all cached rootfs archives, and of the
+        files of guests and layers against the manifests recorded when they
+        were installed or upgraded, hashing files in parallel on all CPUs.
+        Corrupt archives are removed from the cache.
+        """
+        start_time = time.monotonic()
+        state = self._lock_and_read_state(shared=True)
+        self._unlock_and_discard_state()
 
-    def _lock_and_read_state(self):
-        try:
-            logging.debug("Loading state...")
-            self.statefile = open('/var/lib/possum-guests/state', 'r+')
-            fcntl.lockf(self.statefile, fcntl.LOCK_EX)
-            return json.load(self.statefile)
-        except OSError as err:
-            logging.debug("Existing state cannot be opened: %s", err)
-            logging.debug("Creating blank state...")
-            os.makedirs("/var/lib/possum-guests", exist_ok=True)
-            self.statefile = open('/var/lib/possum-guests/state', 'w')
+        # Each check is (description of the thing checked, path, digest)
+        checks = []
+        cache = self._artifact_cache()
+        index = cache.list()
+        for digest in sorted({entry['digest'] for entry in index.values()}):
+            checks.append(("archive " + digest[:12], cache.blob_path(digest),
+                           digest))
+
+        layers = set()
+        skipped = []
+        for (name, guest) in state['guests'].items():
+            manifest_path = os.path.join(guest['path'], "manifest.json")
+            if guest.get('storage') == 'overlay' and \
+                    not os.path.exists(manifest_path):
+                manifest_path = self._layer_store().manifest_path(
+                    guest['layer'])
+            if not os.path.exists(manifest_path):
+                skipped.append(name)
+                continue
+            if guest.get('storage') == 'overlay':
+                # Guests sharing a layer need only check it once
+                if guest['layer'] in layers:
+                    continue
+                layers.add(guest['layer'])
+                description = "layer " + guest['layer'][:12]
+                root_path = self._layer_store().layer_path(guest['layer'])
+                writable = []
+            else:
+                description = "guest \"%s\"" % name
+                recover_rootfs(guest['path'])
+                root_path = os.path.join(guest['path'], "rootfs")
+                writable = [path.strip("/") for path in
+                            guest['image'].get('WRITABLE_PATHS', [])]
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            for (path, entry) in manifest['entries'].items():
+                if entry['type'] == 'file' and \
+                        not in_writable_path(path, writable):
+                    checks.append((description, os.path.join(root_path, path),
+                                   entry['sha256']))
+        if skipped:
+            logging.info("Skipping guests added without a manifest, re-add "
+                         "them to check their files: %s", ", ".join(skipped))
+
+        digests = hash_files([path for (_, path, _) in checks])
+        failures = collections.OrderedDict()
+        for ((description, path, digest), actual) in zip(checks, digests):
+            if actual != digest:
+                failures.setdefault(description, []).append((path, digest))
+        for (description, files) in failures.items():
+            if description.startswith("archive "):
+                logging.error("Cached %s is corrupt, removing it", description)
+                cache.discard(files[0][1])
+            else:
+                logging.error("%s has %d files which do not match its "
+                              "manifest: %s", description[0].upper() +
+                              description[1:], len(files),
+                              ", ".join(path for (path, _) in files[:5]))
+        logging.info("Verified %d files in %.2fs, %d problems found",
+                     len(checks), time.monotonic() - start_time, len(failures))
+
+    @releases_state_on_error
+    def cache_prune(self, max_size=None):
+        cache = self._artifact_cache()
+        if max_size is None:
+            max_size = cache.max_size
+        state = self._lock_and_read_state(shared=True)
+        # Archives stay pinned if pull failed after fetching them
+        pulled = {image['rootfs_url'] for image in state['images'].values()
+                  if image['storage'] != 'overlay'}
+        index = cache.list()
+        cache.unpin([url for url in index
+                     if index[url].get('pinned') and url not in pulled])
+        freed = cache.prune(max_size)
+        logging.info("Freed %s from the cache", format_size(freed))
+
+        used = {guest['layer'] for guest in state['guests'].values()
+                if 'layer' in guest}
+        used.update(image['digest'] for image in state['images'].values()
+                    if image['storage'] == 'overlay')
+        count = self._layer_store().prune(used)
+        self._unlock_and_discard_state()
+        logging.info("Removed %d unused layers", count)
+
+    def _emit_event(self, event, name):
+        """
+        Pass a guest lifecycle event to each registered listener. Listeners may
+        be called from any thread.
+        """
+        if self.transaction is not None:
+            # Changes which are rolled back never happened
+            self.transaction_events.append((event, name))
+            return
+        message = {'event': event, 'guest': name, 'time': time.time()}
+        for listener in list(self.event_listeners):
+            listener(message)
+
+    def regen_specs(self, names=None):
+        state = self._lock_and_read_state(shared=True)
+        self._unlock_and_discard_state()
+        if not names:
+            names = list(state['guests'])
+        for name in names:
+            if name not in state['guests']:
+                logging.error("Guest %s not defined!", name)
+                return
+
+        start_time = time.monotonic()
+        template = self._spec_template()
+        template.get(refresh=True)
+        for name in names:
+            guest = state['guests'][name]
+            create_spec_file(name, guest['path'], guest['image']['COMMAND'],
+                             guest['image']['CAPABILITIES'], template)
+
+        logging.info("Regenerated spec files for %d guests in %.2fs",
+                     len(names), time.monotonic() - start_time)
+        running = [name for (name, container) in self._runc_list().items()
+                   if name in names and container['status'] != 'stopped']
+        if running:
+            logging.info("Restart these guests to apply their new spec files: "
+                         "%s", " ".join(running))
+
+    def _spec_template(self):
+        # Kept for the life of the process so the template is read only once
+        if self.spec_template is None:
+            self.spec_template = SpecTemplate(
+                os.path.join(STATE_ROOT, "cache"))
+        return self.spec_template
+
+    def _artifact_cache(self):
+        cache_path = os.path.join(STATE_ROOT, "cache")
+        return ArtifactCache(cache_path, self.config.getint('cache_size') << 20)
+
+    def _metadata_cache(self):
+        cache_path = os.path.join(STATE_ROOT, "cache", "meta")
+        return MetadataCache(cache_path, self.config.getfloat('metadata_ttl'),
+                             self._http_client(),
+                             self.config.getboolean('offline'))
+
+    def _catalog_cache(self):
+        cache_path = os.path.join(STATE_ROOT, "cache", "meta")
+        return MetadataCache(cache_path, self.config.getfloat('catalog_ttl'),
+                             self._http_client(),
+                             self.config.getboolean('offline'))
+
+    def _http_client(self):
+        # One client is shared by all downloads so connections can be reused
+        if self.http is None:
+            self.http = HttpClient(self.config.getfloat('http_timeout'),
+                                   self.config.getint('download_retries'))
+        return self.http
+
+    def _downloader(self):
+        return Downloader(self._http_client(),
+                          self.config.getint('download_segments'),
+                          self.config.getint('segment_size') << 20)
+
+    def _layer_store(self):
+        return LayerStore(os.path.join(STATE_ROOT, "layers"))
+
+    def _storage_mode(self):
+        storage = self.config.get('storage')
+        if storage == 'auto':
+            storage = 'overlay' if overlayfs_supported() else 'copy'
+        return storage
+
+    @traced("mount_overlay")
+    def _mount_rootfs(self, guest):
+        import subprocess
+        rootfs_path = os.path.join(guest['path'], "rootfs")
+        if os.path.ismount(rootfs_path):
+            return
+        options = "lowerdir=%s,upperdir=%s,workdir=%s" % (
+            self._layer_store().layer_path(guest['layer']),
+            os.path.join(guest['path'], "upper"),
+            os.path.join(guest['path'], "work"))
+        logging.debug("Mounting overlay on \"%s\"...", rootfs_path)
+        subprocess.run(["mount", "-t", "overlay", "overlay", "-o", options,
+                        rootfs_path], check=True)
+
+    def _unmount_rootfs(self, local_path):
+        import subprocess
+        rootfs_path = os.path.join(local_path, "rootfs")
+        if os.path.ismount(rootfs_path):
+            logging.debug("Unmounting overlay from \"%s\"...", rootfs_path)
+            subprocess.run(["umount", rootfs_path], check=True)
+
+    def _runc_list(self):
+        """
+        Return a dict mapping container names to their runc state, gathered
+        with a single 'runc list' call.
+        """
+        import subprocess
+        with TRACER.span("runc list"):
+            result = subprocess.run(["runc", "list", "--format", "json"],
+                                    stdout=subprocess.PIPE, check=True)
+        # runc prints "null" rather than an empty list when nothing exists
+        containers = json.loads(result.stdout.decode('utf-8')) or []
+        return {container['id']: container for container in containers}
+
+    def begin_transaction(self):
+        """
+        Lock the state until end_transaction() is called so that the changes
+        made by all commands run in between are committed or discarded
+        together.
+        """
+        self.transaction = self._lock_and_read_state()
+
+    def end_transaction(self, commit):
+        import shutil
+        state = self.transaction
+        self.transaction = None
+        (paths, removals, events) = (self.transaction_paths,
+                                     self.transaction_removals,
+                                     self.transaction_events)
+        self.transaction_paths = []
+        self.transaction_removals = []
+        self.transaction_events = []
+        if commit:
+            self._unlock_and_write_state(state)
+            for path in removals:
+                self._remove_path(path)
+            for (event, name) in events:
+                self._emit_event(event, name)
+        else:
+            logging.info("Rolling back state changes")
+            for path in reversed(paths):
+                logging.debug("Deleting \"%s\"...", path)
+                self._unmount_rootfs(path)
+                shutil.rmtree(path, ignore_errors=True)
+            self._unlock_and_discard_state()
+
+    def _created_path(self, path):
+        """
+        Note that the guest directory `path` is being created, so that it is
+        deleted again if the current transaction is rolled back.
+        """
+        if self.transaction is not None:
+            self.transaction_paths.append(path)
+
+    def _remove_path(self, path):
+        """
+        Delete the guest directory `path`, or once the current transaction has
+        been committed if there is one.
+        """
+        import shutil
+        if self.transaction is not None:
+            self.transaction_removals.append(path)
+            return
+        self._unmount_rootfs(path)
+        logging.debug("Deleting data from \"%s\"...", path)
+        shutil.rmtree(path)
+
+    @traced("load_state")
+    def _lock_and_read_state(self, shared=False):
+        """
+        Lock and return the state. Commands which only read the state should
+        pass `shared` so that they may run alongside each other. The state
+        loaded by a previous call is reused if the database has not changed.
+        """
+        if self.transaction is not None:
+            return self.transaction
+
+        logging.debug("Loading state...")
+        os.makedirs(STATE_ROOT, exist_ok=True)
+        db_path = os.path.join(STATE_ROOT, "state.db")
+        json_path = os.path.join(STATE_ROOT, "state")
+        self.state_shared = shared
+        if shared and self.unlocked_reads and os.path.exists(db_path):
+            # SQLite keeps each read consistent on its own. The lock file is
+            # not even opened, as closing it would release the locks which
+            # other threads of this process hold on it.
+            self.statefile = None
+        else:
+            self.statefile = open(os.path.join(STATE_ROOT, "state.lock"), 'a+')
+            fcntl.lockf(self.statefile,
+                        fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+
+        if not os.path.exists(db_path) and os.path.exists(json_path):
             fcntl.lockf(self.statefile, fcntl.LOCK_EX)
-            state = {}
-            json.dump(state, self.statefile, indent=4)
-            self.statefile.write("\n")
-            return state
+            if not os.path.exists(db_path):
+                self._migrate_state(json_path, db_path)
+
+        key = self._state_key(db_path)
+        if self.snapshot is not None:
+            if key == self.snapshot_key and self.snapshot.unchanged():
+                logging.debug("Reusing state snapshot...")
+                return self.snapshot
+            self.snapshot.close()
+
+        self.snapshot = PossumState(db_path)
+        self.snapshot_key = self._state_key(db_path)
+        return self.snapshot
 
+    def _state_key(self, db_path):
+        try:
+            st = os.stat(db_path)
+        except FileNotFoundError:
+            return None
+        return (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _migrate_state(self, json_path, db_path):
+        logging.info("Migrating state from \"%s\" to \"%s\"...", json_path,
+                     db_path)
+        state = PossumState(db_path)
+        with open(json_path) as json_file:
+            state.import_json(json.load(json_file))
+        state.close()
+        os.rename(json_path, json_path + ".migrated")
+
+    @traced("commit_state")
     def _unlock_and_write_state(self, state):
+        if self.transaction is not None:
+            return
+
         logging.debug("Writing back state...")
-        self.statefile.seek(0)
-        self.statefile.truncate()
-        json.dump(state, self.statefile, indent=4)
-        self.statefile.write("\n")
+        state.commit()
+        self.snapshot_key = self._state_key(os.path.join(STATE_ROOT,
+                                                         "state.db"))
         self.statefile.close()
 
     def _unlock_and_discard_state(self):
+        if self.transaction is not None:
+            return
+
         logging.debug("Discarding state (read-only command)...")
-        self.statefile.close()
+        if not self.state_shared and self.snapshot is not None:
+            # The state may hold uncommitted changes so cannot be reused
+            self.snapshot.close()
+            self.snapshot = None
+        if self.statefile is not None:
+            self.statefile.close()
+
+    def abort(self):
+        """
+        Release the state lock, if held, and drop the state snapshot after a
+        command raised an exception, as the snapshot may hold changes which
+        were only partly made. Inside a transaction this is left to
+        end_transaction().
+        """
+        if self.transaction is not None:
+            return
+        if self.snapshot is not None:
+            self.snapshot.close()
+            self.snapshot = None
+        if self.statefile is not None and not self.statefile.closed:
+            logging.debug("Releasing state lock after an error...")
+            self.statefile.close()
+
+class ErrorCounter(logging.Handler):
+    """Logging handler which counts the errors logged while it is installed."""
+
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+class LogCapture(logging.Handler):
+    """Logging handler which keeps the level and text of each message."""
+
+    def __init__(self, level):
+        super().__init__(level)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append((record.levelno, record.getMessage()))
+
+class ThreadOutput(io.TextIOBase):
+    """
+    Stand-in for sys.stdout which sends text written by each thread to the
+    stream it set with capture(), then to the stream set with
+    capture_others(), and otherwise to the original stream.
+    """
+
+    def __init__(self, stream):
+        super().__init__()
+        self.stream = stream
+        self.others = None
+        self.local = threading.local()
+
+    def _target(self):
+        target = getattr(self.local, 'stream', None)
+        if target is None:
+            target = self.others
+        return self.stream if target is None else target
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        return self._target().write(text)
+
+    def flush(self):
+        self._target().flush()
+
+    def capture(self, stream):
+        self.local.stream = stream
+
+    def capture_others(self, stream):
+        self.others = stream
+
+def connect_daemon(socket_path):
+    """
+    Return a socket connected to a running possumcmd daemon, or None if no
+    daemon is listening on `socket_path`.
+    """
+    if not os.path.exists(socket_path):
+        return None
+
+    import socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+class PossumDaemon:
+    """
+    Serve possumcmd commands over a UNIX socket from a single long-running
+    process so that state, configuration and connections stay loaded between
+    commands.
+
+    Each request and response is a JSON object on a single line, and a client
+    may send any number of requests on one connection. A request is
+    `{"line": COMMAND_LINE, "verbose": BOOL}` and the response is
+    `{"output": TEXT, "log": [[LEVEL, MESSAGE], ...]}` holding everything the
+    command printed and logged. Clients are served concurrently. Commands
+    which change the state run one at a time, as they would when serialized by
+    the state lock, while those in READ_ONLY_COMMANDS run alongside them with
+    a PossumCmd of their own. A client which sends the line "events" instead
+    receives one JSON object per line for each guest lifecycle event until it
+    disconnects.
+    """
+
+    def __init__(self, socket_path, possumcmd):
+        import queue
+        import socket
+        self.possumcmd = possumcmd
+        self.lock = threading.Lock()
+        # PossumCmd instances for read-only commands which are not in use
+        self.readers = queue.LifoQueue()
+        # Threads running read-only commands, whose output and log messages
+        # are kept out of those of the command holding the lock
+        self.reader_threads = set()
+        self.output = ThreadOutput(sys.stdout)
+        sys.stdout = self.output
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(socket_path)
+        os.chmod(socket_path, 0o600)
+        self.sock.listen()
+
+    def serve_forever(self):
+        while True:
+            (conn, _) = self.sock.accept()
+            threading.Thread(target=self.handle, args=(conn,),
+                             daemon=True).start()
+
+    def server_close(self):
+        self.sock.close()
+        sys.stdout = self.output.stream
+
+    def handle(self, conn):
+        with conn, conn.makefile('rwb') as connfile:
+            try:
+                for line in connfile:
+                    try:
+                        request = json.loads(line.decode('utf-8'))
+                    except ValueError:
+                        logging.debug("Ignoring malformed request: %r", line)
+                        return
+                    if request.get('line') == 'events':
+                        self.stream_events(conn, connfile)
+                        return
+                    response = self.run_command(request)
+                    connfile.write(json.dumps(response).encode('utf-8') + b"\n")
+                    connfile.flush()
+            except OSError as err:
+                # The client went away before reading its response
+                logging.debug("Lost connection to client: %s", err)
+
+    def run_command(self, request):
+        line = request.get('line', '')
+        capture = LogCapture(logging.DEBUG if request.get('verbose')
+                             else logging.INFO)
+        output = io.StringIO()
+        if self.possumcmd.parseline(line)[0] in READ_ONLY_COMMANDS:
+            self.run_read_only(line, capture, output)
+        else:
+            # Includes messages and output from threads the command starts
+            capture.addFilter(
+                lambda record: record.thread not in self.reader_threads)
+            with self.lock:
+                self.output.capture_others(output)
+                try:
+                    self._run(self.possumcmd, line, capture)
+                finally:
+                    self.output.capture_others(None)
+        return {'output': output.getvalue(), 'log': capture.records}
+
+    def run_read_only(self, line, capture, output):
+        import queue
+        thread = threading.get_ident()
+        capture.addFilter(lambda record: record.thread == thread)
+        try:
+            reader = self.readers.get_nowait()
+        except queue.Empty:
+            reader = PossumCmd()
+            reader.sysmgr.unlocked_reads = True
+        self.reader_threads.add(thread)
+        self.output.capture(output)
+        try:
+            self._run(reader, line, capture)
+        finally:
+            self.output.capture(None)
+            self.reader_threads.discard(thread)
+            self.readers.put(reader)
+
+    @staticmethod
+    def _run(possumcmd, line, capture):
+        logging.getLogger().addHandler(capture)
+        try:
+            possumcmd.onecmd(line)
+        except Exception as err: # pylint: disable=broad-except
+            possumcmd.sysmgr.abort()
+            logging.debug("Exception details:", exc_info=True)
+            logging.error("Command raised %s: %s", type(err).__name__, err)
+        finally:
+            logging.getLogger().removeHandler(capture)
+
+    def stream_events(self, sock, wfile):
+        import queue
+        import select
+        import socket
+        events = queue.Queue()
+        listeners = self.possumcmd.sysmgr.event_listeners
+        listeners.append(events.put)
+        try:
+            while True:
+                try:
+                    event = events.get(timeout=1.0)
+                except queue.Empty:
+                    # Notice clients which have gone away while no events
+                    # were sent
+                    readable = select.select([sock], [], [], 0)[0]
+                    if readable and not sock.recv(1, socket.MSG_PEEK):
+                        return
+                    continue
+                wfile.write(json.dumps(event).encode('utf-8') + b"\n")
+                wfile.flush()
+        except OSError:
+            return
+        finally:
+            listeners.remove(events.put)
 
 class PossumCmd(cmd.Cmd):
     intro = "Welcome to %s (%s)" % (APP_NAME, VERSION_STRING)
@@ -437,6 +3923,98 @@ class PossumCmd(cmd.Cmd):
         self.sysmgr = PossumSysmgr()
         super().__init__()
 
+    def default(self, line):
+        logging.error("Unknown command: %s", line)
+
+    def onecmd(self, line):
+        (command, _, _) = self.parseline(line)
+        with TRACER.span(command or "", "command", line=line):
+            return super().onecmd(line)
+
+    def run_remote(self, line):
+        """
+        Run a command in a running daemon, replaying its output and log
+        messages here. Returns False if no daemon is running.
+        """
+        sock = connect_daemon(self.sysmgr.config.get('socket'))
+        if sock is None:
+            return False
+
+        request = {
+            'line': line,
+            'verbose': logging.getLogger().isEnabledFor(logging.DEBUG),
+        }
+        with sock, sock.makefile('rwb') as sockfile:
+            sockfile.write(json.dumps(request).encode('utf-8') + b"\n")
+            sockfile.flush()
+            response = sockfile.readline()
+        if not response:
+            logging.error("Lost connection to possumcmd daemon!")
+            return True
+
+        response = json.loads(response.decode('utf-8'))
+        sys.stdout.write(response['output'])
+        sys.stdout.flush()
+        for (level, message) in response['log']:
+            logging.log(level, "%s", message)
+        return True
+
+    def run_batch(self, batch_file, atomic=False):
+        """
+        Run each command read from `batch_file`, one per line, logging the time
+        taken by each. Blank lines and lines starting with '#' are ignored. A
+        command fails if it logs an error or raises an exception. If `atomic`
+        is set, the batch stops at the first failure and no state changes are
+        kept unless every command succeeds. Returns True if all commands
+        succeeded.
+        """
+        errors = ErrorCounter()
+        logging.getLogger().addHandler(errors)
+        if atomic:
+            self.sysmgr.begin_transaction()
+
+        count = 0
+        failed = 0
+        start_time = time.monotonic()
+        try:
+            for line in batch_file:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+
+                count += 1
+                errors_before = errors.count
+                command_start = time.monotonic()
+                try:
+                    stop = self.onecmd(line)
+                except Exception as err: # pylint: disable=broad-except
+                    self.sysmgr.abort()
+                    logging.debug("Exception details:", exc_info=True)
+                    logging.error("Command raised %s: %s", type(err).__name__,
+                                  err)
+                    stop = False
+                success = errors.count == errors_before
+                logging.info("%.3fs %s%s", time.monotonic() - command_start,
+                             line, "" if success else " (failed)")
+
+                if not success:
+                    failed += 1
+                    if atomic:
+                        break
+                if stop:
+                    break
+        except BaseException:
+            failed += 1
+            raise
+        finally:
+            if atomic:
+                self.sysmgr.end_transaction(commit=failed == 0)
+            logging.getLogger().removeHandler(errors)
+
+        logging.info("Ran %d commands (%d failed) in %.3fs", count, failed,
+                     time.monotonic() - start_time)
+        return failed == 0
+
     def do_add_source(self, line):
         """
         add_source NAME URL
@@ -462,97 +4040,273 @@ class PossumCmd(cmd.Cmd):
         (name, url) = args
         self.sysmgr.add_source(name, url)
 
-    def do_remove_source(self, line):
+    def do_remove_source(self, line):
+        """
+        remove_source NAME
+
+        Remove a previously registered source.
+
+        Arguments:
+
+            NAME    The identifier of the source to remove.
+
+        Example:
+
+            remove_source possum
+        """
+
+        args = line.split()
+        if len(args) != 1:
+            logging.error("Incorrect number of args!")
+            return
+        name = args[0]
+        self.sysmgr.remove_source(name)
+
+    def do_list_sources(self, line):
+        """
+        list_sources
+
+        List all currently registered sources.
+
+        Arguments:
+
+            (none)
+
+        Example:
+
+            list_sources
+        """
+
+        args = line.split()
+        if args:
+            logging.error("Incorrect number of args!")
+            return
+        self.sysmgr.list_sources()
+
+    def do_show_source(self, line):
+        """
+        show_source NAME
+
+        Show details of a previously registered source in JSON format.
+
+        Arguments:
+
+            NAME    The identifier of the source to show.
+
+        Example:
+
+            show_source possum
+        """
+
+        args = line.split()
+        if len(args) != 1:
+            logging.error("Incorrect number of args!")
+            return
+        name = args[0]
+        self.sysmgr.show_source(name)
+
+    def do_list_images(self, line):
+        """
+        list_images [SOURCE]
+
+        List the images available from all sources, or from one source, with
+        their versions and digests. Images are listed in a catalog, index.json,
+        published by each source. Catalogs are cached for 'catalog_ttl'
+        seconds from /etc/possumcmd.conf.
+
+        Arguments:
+
+            SOURCE  The identifier of the source whose images to list.
+
+        Example:
+
+            list_images possum
+        """
+        args = line.split()
+        if len(args) > 1:
+            logging.error("Incorrect number of args!")
+            return
+
+        self.sysmgr.list_images(*args)
+
+    def do_search_images(self, line):
+        """
+        search_images TERM
+
+        List the images available from all sources whose name or description
+        contains TERM, ignoring case. Catalogs are cached as for list_images.
+
+        Arguments:
+
+            TERM    Text to search for.
+
+        Example:
+
+            search_images minimal
+        """
+        args = line.split()
+        if len(args) != 1:
+            logging.error("Incorrect number of args!")
+            return
+
+        self.sysmgr.list_images(term=args[0])
+
+    def do_add_guest(self, line):
+        """
+        add_guest NAME IMAGE
+
+        Create a new guest container from an image. Images which have been
+        fetched by 'pull' are used without contacting their source.
+
+        Arguments:
+
+            NAME    An identifier which may be used to reference this source in
+                    future commands.
+
+            IMAGE   A reference to an image which is available from one of
+                    the sources which has been configured. The format of this
+                    reference is "<source>:<image name>". The source may be
+                    left out if only one source's catalog lists the image.
+
+        Example:
+
+            add_guest test possum:minimal
+        """
+        args = line.split()
+        if len(args) != 2:
+            logging.error("Incorrect number of args!")
+            return
+        (name, image) = args
+
+        self.sysmgr.add_guest(name, image)
+
+    def do_pull(self, line):
         """
-        remove_source NAME
+        pull IMAGE...
 
-        Remove a previously registered source.
+        Fetch one or more images in parallel so that guests can later be
+        created from them without downloading anything. Up to 'fetch_jobs'
+        images from /etc/possumcmd.conf are fetched at once. Pulling an image
+        again updates it to the latest version from its source.
 
         Arguments:
 
-            NAME    The identifier of the source to remove.
+            IMAGE   A reference to an image which is available from one of
+                    the sources which has been configured. The format of this
+                    reference is "<source>:<image name>". The source may be
+                    left out if only one source's catalog lists the image.
 
         Example:
 
-            remove_source possum
+            pull possum:minimal possum:full
         """
-
         args = line.split()
-        if len(args) != 1:
+        if not args:
             logging.error("Incorrect number of args!")
             return
-        name = args[0]
-        self.sysmgr.remove_source(name)
 
-    def do_list_sources(self, line):
+        self.sysmgr.pull(args)
+
+    def do_clone_guest(self, line):
         """
-        list_sources
+        clone_guest SRC DST [--hardlink]
 
-        List all currently registered sources.
+        Create a new guest container as a copy of an existing guest without
+        downloading its image again. The source guest must not be running.
+        Files are copied using reflinks where the filesystem supports them, or
+        copied in full otherwise. Autostart is disabled for the new guest.
 
         Arguments:
 
-            (none)
+            SRC         The identifier of the guest container to copy.
+
+            DST         An identifier which may be used to reference the new
+                        guest in future commands.
+
+            --hardlink  Where reflinks are not supported, hardlink files which
+                        have not changed since the source guest was created
+                        instead of copying them. This saves space, but a
+                        guest which modifies such a file in place also changes
+                        it in the other guest. Guests using overlay storage
+                        never share files this way.
 
         Example:
 
-            list_sources
+            clone_guest test test2
         """
-
         args = line.split()
-        if args:
+        hardlink = "--hardlink" in args
+        if hardlink:
+            args.remove("--hardlink")
+        if len(args) != 2:
             logging.error("Incorrect number of args!")
             return
-        self.sysmgr.list_sources()
+        (src, dst) = args
 
-    def do_show_source(self, line):
+        self.sysmgr.clone_guest(src, dst, hardlink)
+
+    def do_upgrade_guest(self, line):
         """
-        show_source NAME
+        upgrade_guest NAME [IMAGE]
 
-        Show details of a previously registered source in JSON format.
+        Upgrade a stopped guest container to the latest version of its image,
+        or to a different image, downloading only the files which have
+        changed. The image must publish a manifest of its files. Changes made
+        by the guest under the image's writable paths are kept, other changes
+        to the guest's rootfs are replaced by the image's files.
 
         Arguments:
 
-            NAME    The identifier of the source to show.
+            NAME    The identifier of the guest container to upgrade.
+
+            IMAGE   A reference to the image to upgrade to, in the format
+                    "<source>:<image name>" or "<image name>" as for
+                    add_guest. Defaults to the image
+                    the guest was created from.
 
         Example:
 
-            show_source possum
+            upgrade_guest test possum:minimal
         """
-
         args = line.split()
-        if len(args) != 1:
+        if len(args) not in (1, 2):
             logging.error("Incorrect number of args!")
             return
-        name = args[0]
-        self.sysmgr.show_source(name)
 
-    def do_add_guest(self, line):
+        self.sysmgr.upgrade_guest(*args)
+
+    def do_make_manifest(self, line):
         """
-        add_guest NAME IMAGE
+        make_manifest ROOTFS OUTPUT
 
-        Create a new guest container from an image.
+        Write the manifest and file objects which allow guests to be upgraded
+        to an image with 'upgrade_guest'. Publish the contents of OUTPUT next
+        to the image's image_guest.json and set "MANIFEST": "manifest.json" in
+        it. Paths in which guests keep their own changes may be listed in
+        "WRITABLE_PATHS".
 
         Arguments:
 
-            NAME    An identifier which may be used to reference this source in
-                    future commands.
+            ROOTFS  Directory holding the image's root filesystem.
 
-            IMAGE   A fully-qualified reference to an image which is available
-                    from one of the sources which has been configured. The
-                    format of this reference is "<source>:<image name>".
+            OUTPUT  Directory in which to write manifest.json and objects/.
 
         Example:
 
-            add_guest test possum:minimal
+            make_manifest /tmp/minimal-rootfs /srv/possum/guest/minimal
         """
         args = line.split()
         if len(args) != 2:
             logging.error("Incorrect number of args!")
             return
-        (name, image) = args
+        (rootfs_path, output_path) = args
 
-        self.sysmgr.add_guest(name, image)
+        if not os.path.isdir(rootfs_path):
+            logging.error("Directory %s not found!", rootfs_path)
+            return
+        manifest = make_manifest(rootfs_path, output_path)
+        logging.info("Wrote manifest of %d entries to \"%s\"",
+                     len(manifest['entries']), output_path)
 
     def do_remove_guest(self, line):
         """
@@ -578,24 +4332,52 @@ class PossumCmd(cmd.Cmd):
 
     def do_list_guests(self, line):
         """
-        list_sources
+        list_guests [--status [--json]]
 
         List all currently registered guests.
 
         Arguments:
 
-            (none)
+            --status    Show the status of each guest, as for the 'ps' command.
+
+            --json      With --status, print the status in JSON format.
 
         Example:
 
-            list_guests
+            list_guests --status
         """
 
         args = line.split()
-        if args:
-            logging.error("Incorrect number of args!")
+        if not args:
+            self.sysmgr.list_guests()
             return
-        self.sysmgr.list_guests()
+        if args not in (["--status"], ["--status", "--json"]):
+            logging.error("Invalid arguments!")
+            return
+        self.sysmgr.guest_status(json_output="--json" in args)
+
+    def do_ps(self, line):
+        """
+        ps [--json]
+
+        Show the status, PID, creation time and autostart setting of all
+        registered guests, gathered with a single 'runc list' call. Guests
+        which have not been started have the status 'none'.
+
+        Arguments:
+
+            --json  Print a JSON list with one object per guest instead of a
+                    table.
+
+        Example:
+
+            ps --json
+        """
+        args = line.split()
+        if args not in ([], ["--json"]):
+            logging.error("Invalid arguments!")
+            return
+        self.sysmgr.guest_status(json_output=bool(args))
 
     def do_show_guest(self, line):
         """
@@ -663,6 +4445,61 @@ class PossumCmd(cmd.Cmd):
         name = args[0]
         self.sysmgr.disable_guest(name)
 
+    def do_set_guest_after(self, line):
+        """
+        set_guest_after NAME [GUEST...]
+
+        Set the guests which must be started before a previously registered
+        guest when guests are started by autostart_all. Guests listed here
+        which are not enabled are ignored.
+
+        Arguments:
+
+            NAME        The identifier of the guest to modify.
+
+            GUEST...    The identifiers of the guests to start first. If none
+                        are given, any existing ordering is cleared.
+
+        Example:
+
+            set_guest_after test dns
+        """
+
+        args = line.split()
+        if not args:
+            logging.error("Incorrect number of args!")
+            return
+        name = args[0]
+        self.sysmgr.set_guest_deps(name, 'after', args[1:])
+
+    def do_set_guest_requires(self, line):
+        """
+        set_guest_requires NAME [GUEST...]
+
+        Set the guests which must be started successfully before a previously
+        registered guest when guests are started by autostart_all. If any of
+        these guests is not enabled or fails to start, this guest is not
+        started.
+
+        Arguments:
+
+            NAME        The identifier of the guest to modify.
+
+            GUEST...    The identifiers of the required guests. If none are
+                        given, any existing requirements are cleared.
+
+        Example:
+
+            set_guest_requires test dns
+        """
+
+        args = line.split()
+        if not args:
+            logging.error("Incorrect number of args!")
+            return
+        name = args[0]
+        self.sysmgr.set_guest_deps(name, 'requires', args[1:])
+
     def do_start_guest(self, line):
         """
         start_guest NAME
@@ -688,32 +4525,46 @@ class PossumCmd(cmd.Cmd):
 
     def do_stop_guest(self, line):
         """
-        stop_guest NAME
+        stop_guest NAME [TIMEOUT]
 
         Stop a running guest container. SIGTERM is sent to the container so that
-        it can shutdown cleanly. After 10 seconds, the container is halted.
+        it can shutdown cleanly. If it has not exited once the timeout expires,
+        the container is halted.
 
         Arguments:
 
             NAME    The identifier of the guest container to stop.
 
+            TIMEOUT The number of seconds to wait for the container to exit. If
+                    not given, the 'stop_timeout' value from
+                    /etc/possumcmd.conf is used (default 10).
+
         Example:
 
             stop_guest test
         """
         args = line.split()
-        if len(args) != 1:
+        if len(args) not in (1, 2):
             logging.error("Incorrect number of args!")
             return
         name = args[0]
-        self.sysmgr.stop_guest(name)
+        timeout = None
+        if len(args) > 1:
+            try:
+                timeout = float(args[1])
+            except ValueError:
+                logging.error("Invalid timeout \"%s\"!", args[1])
+                return
+        self.sysmgr.stop_guest(name, timeout)
 
     def do_preconfigure(self, line):
         """
         preconfigure
 
         Read pre-configuration data from `/usr/share/possum/preconfig.d` and
-        add the listed sources and guests.
+        add the listed sources and guests. Guest sections may also set 'after'
+        and 'requires' to lists of guests, as for set_guest_after and
+        set_guest_requires.
 
         Arguments:
 
@@ -731,43 +4582,65 @@ class PossumCmd(cmd.Cmd):
 
     def do_autostart_all(self, line):
         """
-        autostart_all
+        autostart_all [JOBS]
 
-        Start all containers which have autostart enabled.
+        Start all containers which have autostart enabled. Containers are
+        started in parallel, respecting any ordering set with set_guest_after
+        and set_guest_requires.
 
         Arguments:
 
-            (none)
+            JOBS    The maximum number of containers to start at once. If not
+                    given, the 'start_jobs' value from /etc/possumcmd.conf is
+                    used (default 4).
 
         Example:
 
-            autostart_all
+            autostart_all 8
         """
         args = line.split()
-        if args:
+        if len(args) > 1:
             logging.error("Incorrect number of args!")
             return
-        self.sysmgr.autostart_all()
+        jobs = None
+        if args:
+            try:
+                jobs = int(args[0])
+            except ValueError:
+                logging.error("Invalid number of jobs \"%s\"!", args[0])
+                return
+        self.sysmgr.autostart_all(jobs)
 
     def do_autostop_all(self, line):
         """
-        autostop_all
+        autostop_all [TIMEOUT]
 
-        Stop all currently running containers.
+        Stop all currently running containers. SIGTERM is sent to all
+        containers at once and any which have not exited when the timeout
+        expires are halted.
 
         Arguments:
 
-            (none)
+            TIMEOUT The number of seconds to wait for the containers to exit.
+                    If not given, the 'stop_timeout' value from
+                    /etc/possumcmd.conf is used (default 10).
 
         Example:
 
             autostop_all
         """
         args = line.split()
-        if args:
+        if len(args) > 1:
             logging.error("Incorrect number of args!")
             return
-        self.sysmgr.autostop_all()
+        timeout = None
+        if args:
+            try:
+                timeout = float(args[0])
+            except ValueError:
+                logging.error("Invalid timeout \"%s\"!", args[0])
+                return
+        self.sysmgr.autostop_all(timeout)
 
     def do_startup(self, line):
         """
@@ -839,6 +4712,312 @@ class PossumCmd(cmd.Cmd):
 
         self.sysmgr.runc(name, runc_args)
 
+    def do_cache_list(self, line):
+        """
+        cache_list
+
+        List the rootfs archives held in the local cache, least recently used
+        first. The digest, size, time of last use and source URL of each
+        archive are shown.
+
+        Arguments:
+
+            (none)
+
+        Example:
+
+            cache_list
+        """
+        args = line.split()
+        if args:
+            logging.error("Incorrect number of args!")
+            return
+        self.sysmgr.cache_list()
+
+    def do_cache_prune(self, line):
+        """
+        cache_prune [SIZE]
+
+        Remove the least recently used rootfs archives from the local cache
+        until it is no larger than the given size. The archives and layers of
+        pulled images are kept until their source is removed. Shared image
+        layers which are no longer used by any guest are also removed.
+
+        Arguments:
+
+            SIZE    The maximum size of the cache in MiB. If not given, the
+                    'cache_size' value from /etc/possumcmd.conf is used
+                    (default 1024). Use 0 to empty the cache.
+
+        Example:
+
+            cache_prune 0
+        """
+        args = line.split()
+        if len(args) > 1:
+            logging.error("Incorrect number of args!")
+            return
+        max_size = None
+        if args:
+            try:
+                max_size = int(args[0]) << 20
+            except ValueError:
+                logging.error("Invalid size \"%s\"!", args[0])
+                return
+        self.sysmgr.cache_prune(max_size)
+
+    def do_verify(self, line):
+        """
+        verify
+
+        Check that cached rootfs archives and the files of guest containers
+        have not been corrupted, using the SHA-256 digests recorded for them.
+        Corrupt archives are removed from the cache. Guests are checked against
+        a manifest of their files recorded when they were added or upgraded.
+        Files in the image's writable paths are not checked.
+
+        Arguments:
+
+            (none)
+
+        Example:
+
+            verify
+        """
+        args = line.split()
+        if args:
+            logging.error("Incorrect number of args!")
+            return
+
+        self.sysmgr.verify()
+
+    def do_daemon(self, line):
+        """
+        daemon
+
+        Run in the foreground as a daemon which serves requests on the UNIX
+        socket given by the 'socket' value in /etc/possumcmd.conf (default
+        /run/possumcmd.sock). While the daemon is running, other possumcmd
+        commands are passed to it instead of loading the state themselves.
+        Stop the daemon with SIGTERM or SIGINT.
+
+        Arguments:
+
+            (none)
+
+        Example:
+
+            daemon
+        """
+        import signal
+        args = line.split()
+        if args:
+            logging.error("Incorrect number of args!")
+            return
+
+        socket_path = self.sysmgr.config.get('socket')
+        sock = connect_daemon(socket_path)
+        if sock is not None:
+            sock.close()
+            logging.error("possumcmd daemon already running on \"%s\"!",
+                          socket_path)
+            return
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+        # Let clients ask for debug messages without printing them here
+        root = logging.getLogger()
+        for handler in root.handlers:
+            if handler.level == logging.NOTSET:
+                handler.setLevel(root.level)
+        root.setLevel(logging.DEBUG)
+
+        server = PossumDaemon(socket_path, self)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        logging.info("Serving requests on \"%s\"", socket_path)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.unlink(socket_path)
+            logging.info("possumcmd daemon stopped")
+
+    def do_events(self, line):
+        """
+        events
+
+        Print guest lifecycle events reported by a running daemon as they
+        happen, one JSON object per line, until interrupted. Only changes made
+        through the daemon are reported.
+
+        Arguments:
+
+            (none)
+
+        Example:
+
+            events
+        """
+        args = line.split()
+        if args:
+            logging.error("Incorrect number of args!")
+            return
+
+        sock = connect_daemon(self.sysmgr.config.get('socket'))
+        if sock is None:
+            logging.error("possumcmd daemon is not running!")
+            return
+
+        with sock, sock.makefile('rwb') as sockfile:
+            sockfile.write(json.dumps({'line': 'events'}).encode('utf-8') + b"\n")
+            sockfile.flush()
+            try:
+                for event in sockfile:
+                    print(event.decode('utf-8').rstrip("\n"), flush=True)
+            except KeyboardInterrupt:
+                pass
+
+    def do_regen_specs(self, line):
+        """
+        regen_specs [NAME...]
+
+        Regenerate the runc spec file of existing guest containers from a fresh
+        copy of the base spec given by 'runc spec'. Running guests keep their
+        current spec until they are restarted.
+
+        Arguments:
+
+            NAME... The identifiers of the guest containers whose spec files
+                    will be regenerated. If none are given, the spec files of
+                    all guests are regenerated.
+
+        Example:
+
+            regen_specs
+        """
+        names = line.split()
+        self.sysmgr.regen_specs(names)
+
+    def do_metrics(self, line):
+        """
+        metrics [--output FILE] [--interval SECONDS]
+
+        Print CPU, memory, process and IO usage of all running guests in
+        Prometheus text format, read directly from each guest's cgroup.
+
+        Arguments:
+
+            --output FILE       Write the metrics to FILE instead, replacing it
+                                atomically. Use a '.prom' file in the textfile
+                                collector directory of node_exporter.
+
+            --interval SECONDS  Keep running and write the metrics again every
+                                SECONDS seconds until interrupted.
+
+        Example:
+
+            metrics --output /var/lib/node_exporter/possum.prom --interval 10
+        """
+        args = line.split()
+        options = {}
+        while args:
+            if args[0] not in ("--output", "--interval") or len(args) < 2:
+                logging.error("Invalid arguments!")
+                return
+            options[args[0]] = args[1]
+            args = args[2:]
+
+        interval = None
+        if "--interval" in options:
+            try:
+                interval = float(options["--interval"])
+            except ValueError:
+                logging.error("Invalid interval \"%s\"!", options["--interval"])
+                return
+            if interval <= 0:
+                logging.error("Invalid interval \"%s\"!", options["--interval"])
+                return
+
+        try:
+            self.sysmgr.metrics(options.get("--output"), interval)
+        except KeyboardInterrupt:
+            pass
+
+    def do_logs(self, line):
+        """
+        logs NAME [--tail N] [--follow]
+
+        Print the output of a guest container from its current log file. Older
+        output is kept in rotated files compressed with gzip alongside it, as
+        limited by the 'log_size' and 'log_count' values in
+        /etc/possumcmd.conf. See 'rotate_logs'.
+
+        Arguments:
+
+            NAME        Name of the guest container.
+
+            --tail N    Print only the last N lines.
+
+            --follow    Keep printing new output as it is written until
+                        interrupted.
+
+        Example:
+
+            logs myguest --tail 20 --follow
+        """
+        args = line.split()
+        if not args:
+            logging.error("Incorrect number of args!")
+            return
+        name = args.pop(0)
+        lines = None
+        follow = False
+        while args:
+            if args[0] == "--follow":
+                follow = True
+                args = args[1:]
+            elif args[0] == "--tail" and len(args) > 1:
+                try:
+                    lines = int(args[1])
+                except ValueError:
+                    lines = -1
+                if lines < 0:
+                    logging.error("Invalid line count \"%s\"!", args[1])
+                    return
+                args = args[2:]
+            else:
+                logging.error("Invalid arguments!")
+                return
+
+        try:
+            self.sysmgr.guest_logs(name, lines, follow)
+        except KeyboardInterrupt:
+            pass
+
+    def do_rotate_logs(self, line):
+        """
+        rotate_logs [NAME...]
+
+        Rotate the log files of the given guests, or of all guests, which have
+        grown beyond the 'log_size' value in /etc/possumcmd.conf. Guests write
+        their output directly to their log file, which is otherwise only
+        rotated when the guest is started, so the possum-logs.timer systemd
+        unit runs this every 5 minutes. Output written while a log is being
+        rotated may be lost.
+
+        Arguments:
+
+            NAME    Name of a guest container.
+
+        Example:
+
+            rotate_logs myguest
+        """
+        args = line.split()
+        self.sysmgr.rotate_logs(args or None)
+
     def do_version(self, _):
         """
         version
@@ -860,6 +5039,11 @@ class PossumCmd(cmd.Cmd):
         print("=======================")
         print()
         print("    -v/--verbose         Print verbose debug messages during operation")
+        print("    --offline            Use cached image metadata without contacting sources")
+        print("    --batch FILE         Run commands read from FILE, or stdin if FILE is '-'")
+        print("    --atomic             With --batch, keep state changes only if all commands succeed")
+        print("    --profile            Print the time taken by each phase of the command")
+        print("    --trace FILE         Write timings to FILE in Chrome trace event format")
         print("    -h/--help [topic]    Print help and exit")
         print("    -V/--version         Print version string and exit")
 
@@ -867,24 +5051,82 @@ def main():
     # possumcmd is typically used interactively so keep log messages simple
     logging.basicConfig(level=logging.INFO, format="%(message)s")
 
-    # Really dumb handling for '-v'/'--verbose' argument
-    if len(sys.argv) > 1:
-        if sys.argv[1] in ("-v", "--verbose"):
+    # Really dumb handling for leading option arguments
+    possumcmd = PossumCmd()
+    batch = None
+    atomic = False
+    offline = False
+    profile = False
+    trace_path = None
+    while len(sys.argv) > 1 and sys.argv[1] in ("-v", "--verbose", "--offline",
+                                                "--batch", "--atomic",
+                                                "--profile", "--trace"):
+        if sys.argv[1] == "--offline":
+            possumcmd.sysmgr.config['offline'] = 'yes'
+            offline = True
+        elif sys.argv[1] == "--batch" and len(sys.argv) > 2:
+            batch = sys.argv[2]
+            del sys.argv[2]
+        elif sys.argv[1] == "--atomic":
+            atomic = True
+        elif sys.argv[1] == "--profile":
+            profile = True
+        elif sys.argv[1] == "--trace" and len(sys.argv) > 2:
+            trace_path = sys.argv[2]
+            del sys.argv[2]
+        elif sys.argv[1] in ("-v", "--verbose"):
             logging.getLogger().setLevel(logging.DEBUG)
-            del sys.argv[1]
+        else:
+            logging.error("Missing argument for %s!", sys.argv[1])
+            sys.exit(1)
+        del sys.argv[1]
+
+    TRACER.enabled = profile or trace_path is not None
+    try:
+        success = run_main(possumcmd, batch, atomic,
+                           offline or TRACER.enabled)
+    finally:
+        if profile:
+            TRACER.print_profile()
+        if trace_path is not None:
+            TRACER.write_trace(trace_path)
+    if not success:
+        sys.exit(1)
+
+def run_main(possumcmd, batch, atomic, local):
+    """
+    Run the batch or the command given by the remaining arguments, or an
+    interactive shell if there are none. Commands are passed to a running
+    daemon unless `local` is set. Returns False if a batch failed.
+    """
+    if batch is not None:
+        if batch == "-":
+            return possumcmd.run_batch(sys.stdin, atomic)
+        with open(batch) as batch_file:
+            return possumcmd.run_batch(batch_file, atomic)
 
-    possumcmd = PossumCmd()
     if len(sys.argv) > 1:
         # Convert common option-style arguments into commands
         if sys.argv[1] in ("-h", "--help"):
             sys.argv[1] = "help"
         elif sys.argv[1] in ("-V", "--version"):
             sys.argv[1] = "version"
+        elif sys.argv[1] == "metrics" and "--output" in sys.argv[2:-1]:
+            # Relative to this directory, not that of a daemon running it
+            i = sys.argv.index("--output", 2) + 1
+            sys.argv[i] = os.path.abspath(sys.argv[i])
 
         line = ' '.join(sys.argv[1:])
-        possumcmd.onecmd(line)
+        # A periodic metrics writer would keep the daemon busy forever. The
+        # daemon has its own configuration so cannot honour --offline and
+        # cannot be traced from here
+        periodic = sys.argv[1] == "metrics" and "--interval" in sys.argv
+        if sys.argv[1] in LOCAL_COMMANDS or local or periodic or \
+                not possumcmd.run_remote(line):
+            possumcmd.onecmd(line)
     else:
         possumcmd.cmdloop()
+    return True
 
 if __name__ == '__main__':
     main()